@@ -101,8 +101,8 @@ class ClaudeClient:
                 # Compaction 会在服务端自动处理
                 log.debug("Compaction API available (trigger at %d tokens)", COMPACTION_TRIGGER_TOKENS)
 
-            full_text = ""
-            full_thinking = ""
+            # 增量先收集到列表，结束时拼接一次（避免逐 delta 的字符串拼接）
+            text_parts: list[str] = []
             usage = UsageInfo()
 
             with self._client.messages.stream(**kwargs) as stream:
@@ -120,11 +120,10 @@ class ClaudeClient:
                             delta_type = getattr(delta, "type", "")
                             if delta_type == "text_delta":
                                 txt = getattr(delta, "text", "")
-                                full_text += txt
+                                text_parts.append(txt)
                                 yield StreamEvent(type="text", text=txt)
                             elif delta_type == "thinking_delta":
                                 txt = getattr(delta, "thinking", "")
-                                full_thinking += txt
                                 yield StreamEvent(type="thinking", text=txt)
 
                 # Get final message for usage
@@ -160,7 +159,7 @@ class ClaudeClient:
 
                 yield StreamEvent(
                     type="done",
-                    text=full_text,
+                    text="".join(text_parts),
                     usage=usage,
                     stop_reason=getattr(final, "stop_reason", "") if final else "",
                 )
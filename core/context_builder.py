@@ -25,7 +25,7 @@ from config import (
     CACHE_WRITE_MULTIPLIER_1H,
     COMPACTION_TRIGGER_TOKENS,
 )
-from core.document_processor import DocumentProcessor
+from core.document_processor import DocumentProcessor, format_document
 from core.conversation_manager import ConversationManager, Message
 from core.token_tracker import TokenTracker
 from data.database import db
@@ -205,10 +205,13 @@ class ContextBuilder:
         
         复用 build() 逻辑来准确预估，而非简单估算全量历史
         """
-        # 获取系统内容 token
-        doc_context = self.doc_processor.get_project_context(project_id)
-        system_text = self._build_system_text(system_prompt, doc_context)
-        system_tokens = self.tracker.estimate_tokens(system_text)
+        # 获取系统内容 token：文档正文直接汇总上传时已存的 token_count，不再读取并重新计数；
+        # 系统提示、<project_knowledge> 与每个文档的 <document name=...> 包装按空正文的骨架估算
+        docs, doc_tokens = self.doc_processor.get_project_documents_with_total(project_id)
+        scaffold = "\n\n".join(format_document(d["filename"], "") for d in docs)
+        system_tokens = self.tracker.estimate_tokens(
+            self._build_system_text(system_prompt, scaffold)
+        ) + doc_tokens
 
         # 获取摘要 token
         conv = self.conv_manager.get_conversation(conversation_id)
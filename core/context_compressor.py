@@ -236,7 +236,7 @@ class ContextCompressor:
         messages = [{"role": "user", "content": user_prompt}]
         system = [{"type": "text", "text": system_prompt}]
         
-        full_text = ""
+        text_parts: list[str] = []
         for event in client.stream_message(
             messages=messages,
             system_content=system,
@@ -244,13 +244,13 @@ class ContextCompressor:
             max_tokens=MAX_SUMMARY_TOKENS,
         ):
             if event.type == "text":
-                full_text += event.text
+                text_parts.append(event.text)
             elif event.type == "error":
                 raise RuntimeError(f"Compression error: {event.error}")
             elif event.type == "done":
                 break
 
-        return full_text.strip()
+        return "".join(text_parts).strip()
 
     def _format_conversation_turns(self, messages: list[Message]) -> str:
         """将消息格式化为压缩提示"""
@@ -11,6 +11,51 @@ from data.database import db
 
 log = logging.getLogger(__name__)
 
+# get_messages 使用的列顺序（与 _tuple_to_msg 的解包顺序一致）
+_MESSAGE_COLUMNS = (
+    "id, conversation_id, role, content, thinking_content, attachments_json, "
+    "model_used, input_tokens, output_tokens, cache_read_tokens, "
+    "cache_creation_tokens, cost_usd, created_at"
+)
+_INSERT_MESSAGE_SQL = (
+    f"INSERT INTO messages ({_MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+# 统计面板：消息用量 + api_call_log 缓存命中 + 压缩状态，一次查询取齐
+# 未压缩消息 = 排在 last_compressed_msg_id 之后的消息（与 get_messages 的顺序一致）
+_FULL_STATS_SQL = """
+    SELECT
+        m.msg_count, m.total_input, m.total_output,
+        m.total_cache_read, m.total_cache_create, m.total_cost,
+        a.api_calls, a.cache_hits, a.api_cache_read,
+        COALESCE(c.rolling_summary, '') != '' AS has_summary,
+        COALESCE(c.summary_token_count, 0) AS summary_tokens,
+        COALESCE(c.compress_after_turns, 10) AS compress_after_turns,
+        CASE WHEN mk.created_at IS NULL THEN m.msg_count ELSE (
+            SELECT COUNT(1) FROM messages
+            WHERE conversation_id = :cid
+              AND (created_at > mk.created_at
+                   OR (created_at = mk.created_at AND rowid > mk.rowid))
+        ) END AS uncompressed_count
+    FROM (
+        SELECT COUNT(1) AS msg_count,
+               COALESCE(SUM(input_tokens), 0) AS total_input,
+               COALESCE(SUM(output_tokens), 0) AS total_output,
+               COALESCE(SUM(cache_read_tokens), 0) AS total_cache_read,
+               COALESCE(SUM(cache_creation_tokens), 0) AS total_cache_create,
+               COALESCE(SUM(cost_usd), 0.0) AS total_cost
+        FROM messages WHERE conversation_id = :cid
+    ) m
+    CROSS JOIN (
+        SELECT COUNT(1) AS api_calls,
+               COALESCE(SUM(cache_read_tokens > 0), 0) AS cache_hits,
+               COALESCE(SUM(cache_read_tokens), 0) AS api_cache_read
+        FROM api_call_log WHERE conversation_id = :cid
+    ) a
+    LEFT JOIN conversations c ON c.id = :cid
+    LEFT JOIN messages mk
+        ON mk.conversation_id = :cid AND mk.id = c.last_compressed_msg_id
+"""
+
 
 @dataclass
 class Message:
@@ -55,13 +100,14 @@ class ConversationManager:
                             model_override: str | None = None) -> Conversation:
         cid = str(uuid.uuid4())
         now = datetime.now(timezone.utc).isoformat()
-        db.execute(
-            """INSERT INTO conversations (id, project_id, title, model_override, created_at, updated_at, compress_after_turns)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (cid, project_id, title, model_override, now, now, 10),
-        )
-        # Touch project updated_at
-        db.execute("UPDATE projects SET updated_at = ? WHERE id = ?", (now, project_id))
+        with db.transaction():
+            db.execute(
+                """INSERT INTO conversations (id, project_id, title, model_override, created_at, updated_at, compress_after_turns)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (cid, project_id, title, model_override, now, now, 10),
+            )
+            # Touch project updated_at
+            db.execute("UPDATE projects SET updated_at = ? WHERE id = ?", (now, project_id))
         log.info("Created conversation '%s' in project %s", title, project_id[:8])
         return Conversation(id=cid, project_id=project_id, title=title,
                             model_override=model_override, created_at=now, updated_at=now,
@@ -107,23 +153,29 @@ class ConversationManager:
                     model_used: str = "",
                     input_tokens: int = 0, output_tokens: int = 0,
                     cache_read_tokens: int = 0, cache_creation_tokens: int = 0,
-                    cost_usd: float = 0.0) -> Message:
+                    cost_usd: float = 0.0, defer: bool = False) -> Message:
+        """Insert a message and touch its conversation.
+
+        defer=True 时写入进入 db 的延迟队列（与后续写入合并提交），
+        不在调用方线程上等待 COMMIT；之后的任何读取都会先落盘。
+        """
         mid = str(uuid.uuid4())
         now = datetime.now(timezone.utc).isoformat()
         att_json = json.dumps(attachments or [])
-        db.execute(
-            """INSERT INTO messages
-               (id, conversation_id, role, content, thinking_content, attachments_json,
-                model_used, input_tokens, output_tokens, cache_read_tokens,
-                cache_creation_tokens, cost_usd, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (mid, conversation_id, role, content, thinking_content, att_json,
-             model_used, input_tokens, output_tokens, cache_read_tokens,
-             cache_creation_tokens, cost_usd, now),
-        )
+        insert = (_INSERT_MESSAGE_SQL,
+                  (mid, conversation_id, role, content, thinking_content, att_json,
+                   model_used, input_tokens, output_tokens, cache_read_tokens,
+                   cache_creation_tokens, cost_usd, now))
         # Touch conversation
-        db.execute("UPDATE conversations SET updated_at = ? WHERE id = ?",
-                   (now, conversation_id))
+        touch = ("UPDATE conversations SET updated_at = ? WHERE id = ?", (now, conversation_id))
+        if defer:
+            db.defer(*insert)
+            db.defer(*touch)
+        else:
+            # INSERT + touch 合并为一次提交
+            with db.transaction():
+                db.execute(*insert)
+                db.execute(*touch)
         log.debug("Saved %s message (%d in / %d out tokens) in conv %s",
                   role, input_tokens, output_tokens, conversation_id[:8])
         return Message(
@@ -135,20 +187,30 @@ class ConversationManager:
         )
 
     def get_messages(self, conversation_id: str, limit: int = 0) -> list[Message]:
+        # 热路径：显式列顺序 + 元组行，避免 sqlite3.Row 按列名查找
         if limit > 0:
-            rows = db.execute(
-                """SELECT * FROM (
+            rows = db.execute_tuples(
+                f"""SELECT {_MESSAGE_COLUMNS} FROM (
                      SELECT * FROM messages WHERE conversation_id = ?
                      ORDER BY created_at DESC LIMIT ?
                    ) sub ORDER BY created_at ASC""",
                 (conversation_id, limit),
             )
         else:
-            rows = db.execute(
-                "SELECT * FROM messages WHERE conversation_id = ? ORDER BY created_at ASC",
+            rows = db.execute_tuples(
+                f"SELECT {_MESSAGE_COLUMNS} FROM messages "
+                "WHERE conversation_id = ? ORDER BY created_at ASC",
                 (conversation_id,),
             )
-        return [self._row_to_msg(r) for r in rows]
+        return [self._tuple_to_msg(r) for r in rows]
+
+    def message_count(self, conversation_id: str) -> int:
+        """Number of messages in a conversation (no rows are materialized)."""
+        row = db.execute_one(
+            "SELECT COUNT(1) FROM messages WHERE conversation_id = ?",
+            (conversation_id,),
+        )
+        return row[0] if row else 0
 
     def get_conversation_stats(self, conversation_id: str) -> dict:
         """Get token usage stats for a conversation."""
@@ -168,6 +230,20 @@ class ConversationManager:
         return {"msg_count": 0, "total_input": 0, "total_output": 0,
                 "total_cache_read": 0, "total_cache_create": 0, "total_cost": 0.0}
 
+    def get_full_stats(self, conversation_id: str) -> dict:
+        """Usage, API cache and compression stats for the stats panel in one query.
+
+        合并 get_conversation_stats、get_compression_stats 与 api_call_log 聚合，
+        不再为统计加载整段消息。
+        """
+        stats = dict(db.execute_one(_FULL_STATS_SQL, {"cid": conversation_id}))
+        stats["has_summary"] = bool(stats["has_summary"])
+        # 每条消息算一轮 (user + assistant 算2条消息)
+        turns = stats["uncompressed_count"] // 2
+        stats["uncompressed_turns"] = turns
+        stats["should_compress"] = turns >= stats["compress_after_turns"]
+        return stats
+
     def get_project_stats(self, project_id: str) -> dict:
         """Get total token stats across all conversations in a project."""
         row = db.execute_one(
@@ -281,6 +357,27 @@ class ConversationManager:
             "should_compress": turns >= conv.compress_after_turns,
         }
 
+    def _tuple_to_msg(self, row: tuple) -> Message:
+        """Build a Message from a tuple laid out as _MESSAGE_COLUMNS."""
+        (msg_id, conv_id, role, content, thinking, attachments_json, model_used,
+         input_tokens, output_tokens, cache_read, cache_creation, cost, created_at) = row
+        att = []
+        try:
+            att = json.loads(attachments_json or "[]")
+        except json.JSONDecodeError:
+            pass
+        return Message(
+            id=msg_id, conversation_id=conv_id, role=role, content=content,
+            thinking_content=thinking or "",
+            attachments=att, model_used=model_used or "",
+            input_tokens=input_tokens or 0,
+            output_tokens=output_tokens or 0,
+            cache_read_tokens=cache_read or 0,
+            cache_creation_tokens=cache_creation or 0,
+            cost_usd=cost or 0.0,
+            created_at=created_at,
+        )
+
     def _row_to_msg(self, row) -> Message:
         att = []
         try:
@@ -20,6 +20,11 @@ TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".tsv", ".json", ".xml", ".yaml", ".ym
                    ".cfg", ".conf", ".log", ".html", ".css", ".jsx", ".tsx", ".vue"}
 
 
+def format_document(filename: str, text: str) -> str:
+    """Wrap one document's text in the <document> block sent as project context."""
+    return f'<document name="{filename}">\n{text}\n</document>'
+
+
 class DocumentProcessor:
     """Extracts text content from documents and manages project files."""
 
@@ -80,6 +85,19 @@ class DocumentProcessor:
         )
         return [dict(r) for r in rows]
 
+    def get_project_documents_with_total(self, project_id: str) -> tuple[list[dict], int]:
+        """Get the document list (id, filename, token_count) and the project token total.
+
+        供文档列表使用：不读取 extracted_text，总数由 SQLite 在同一查询中汇总。
+        """
+        rows = db.execute_tuples(
+            "SELECT id, filename, token_count, SUM(token_count) OVER () FROM documents "
+            "WHERE project_id = ? ORDER BY created_at ASC",
+            (project_id,),
+        )
+        docs = [{"id": r[0], "filename": r[1], "token_count": r[2] or 0} for r in rows]
+        return docs, (rows[0][3] or 0) if rows else 0
+
     def get_project_context(self, project_id: str) -> str:
         """Get concatenated document text for API context."""
         rows = db.execute(
@@ -88,10 +106,7 @@ class DocumentProcessor:
         )
         if not rows:
             return ""
-        parts = []
-        for r in rows:
-            parts.append(f'<document name="{r["filename"]}">\n{r["extracted_text"]}\n</document>')
-        return "\n\n".join(parts)
+        return "\n\n".join(format_document(r["filename"], r["extracted_text"]) for r in rows)
 
     def get_total_tokens(self, project_id: str) -> int:
         """Get total token count for all project documents."""
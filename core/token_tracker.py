@@ -14,6 +14,22 @@ from config import (
 
 log = logging.getLogger(__name__)
 
+# 整数定价表：model_id -> (input, output)，单位为 微美元 / 百万 tokens
+# 例：Sonnet 输入 $3/Mtok -> 3_000_000
+_PRICE_VECTOR: dict[str, tuple[int, int]] = {
+    mid: (round(m.input_price * 1_000_000), round(m.output_price * 1_000_000))
+    for mid, m in MODELS.items()
+}
+_FALLBACK_PRICE = _PRICE_VECTOR["claude-sonnet-4-5-20250929"]
+
+# 缓存乘数以百分比整数表示 (1.25 -> 125)
+_WRITE_PCT_5M = round(CACHE_WRITE_MULTIPLIER_5M * 100)
+_WRITE_PCT_1H = round(CACHE_WRITE_MULTIPLIER_1H * 100)
+_READ_PCT = round(CACHE_READ_MULTIPLIER * 100)
+
+# tokens * 微美元/Mtok * 百分比 的单位是 1e-14 USD；1e8 个单位 = 1 微美元
+_UNITS_PER_MICRO_USD = 100_000_000
+
 
 @dataclass
 class UsageInfo:
@@ -43,6 +59,7 @@ class TokenTracker:
         """初始化 TokenTracker，可选指定 cache_ttl ('5m' 或 '1h')"""
         self._cache_ttl = cache_ttl
         self._write_multiplier = CACHE_WRITE_MULTIPLIER_1H if cache_ttl == "1h" else CACHE_WRITE_MULTIPLIER_5M
+        self._write_pct = _WRITE_PCT_1H if cache_ttl == "1h" else _WRITE_PCT_5M
 
     @property
     def cache_ttl(self) -> str:
@@ -53,30 +70,35 @@ class TokenTracker:
         """设置缓存 TTL 并更新写入乘数"""
         self._cache_ttl = value
         self._write_multiplier = CACHE_WRITE_MULTIPLIER_1H if value == "1h" else CACHE_WRITE_MULTIPLIER_5M
+        self._write_pct = _WRITE_PCT_1H if value == "1h" else _WRITE_PCT_5M
 
     def calculate_cost(self, model_id: str, usage: UsageInfo) -> float:
-        """Calculate cost in USD for a single API call."""
-        model = MODELS.get(model_id)
-        if not model:
-            log.warning("Unknown model '%s', using Sonnet 4.5 pricing", model_id)
-            model = MODELS["claude-sonnet-4-5-20250929"]
+        """Calculate cost in USD for a single API call.
 
-        inp_price = model.input_price / 1_000_000
-        out_price = model.output_price / 1_000_000
-
-        cost = (
-            usage.input_tokens * inp_price
-            + usage.output_tokens * out_price
-            + usage.cache_creation_tokens * inp_price * self._write_multiplier
-            + usage.cache_read_tokens * inp_price * CACHE_READ_MULTIPLIER
+        全程整数运算，最后一次性四舍五入到微美元 (6 位小数)，避免浮点累积误差。
+        """
+        price = _PRICE_VECTOR.get(model_id)
+        if price is None:
+            log.warning("Unknown model '%s', using Sonnet 4.5 pricing", model_id)
+            price = _FALLBACK_PRICE
+        inp_price, out_price = price
+
+        units = (
+            usage.input_tokens * inp_price * 100
+            + usage.output_tokens * out_price * 100
+            + usage.cache_creation_tokens * inp_price * self._write_pct
+            + usage.cache_read_tokens * inp_price * _READ_PCT
         )
+        micro_usd = (units + _UNITS_PER_MICRO_USD // 2) // _UNITS_PER_MICRO_USD
+        cost = micro_usd / 1_000_000
 
-        log.debug(
-            "Cost calc [%s]: %d in + %d out + %d cache_write (%.2fx) + %d cache_read = $%.6f",
-            model_id, usage.input_tokens, usage.output_tokens,
-            usage.cache_creation_tokens, self._write_multiplier, usage.cache_read_tokens, cost,
-        )
-        return round(cost, 6)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Cost calc [%s]: %d in + %d out + %d cache_write (%.2fx) + %d cache_read = $%.6f",
+                model_id, usage.input_tokens, usage.output_tokens,
+                usage.cache_creation_tokens, self._write_multiplier, usage.cache_read_tokens, cost,
+            )
+        return cost
 
     def estimate_cost_with_cache(
         self, 
@@ -156,3 +178,14 @@ class TokenTracker:
             return len(enc.encode(text))
         except ImportError:
             return len(text) // 4
+
+
+def prewarm_encoder() -> None:
+    """预加载 tiktoken 编码器（后台线程调用），避免首次 estimate_tokens 阻塞 UI。"""
+    try:
+        import tiktoken
+        tiktoken.get_encoding("cl100k_base")
+        log.debug("tiktoken encoder pre-warmed")
+    except Exception:
+        # tiktoken 缺失或编码文件下载失败时，estimate_tokens 会自行回退
+        pass
@@ -1,8 +1,11 @@
 """SQLite database layer with schema management and migrations."""
 from __future__ import annotations
 
+import os
+import hashlib
 import sqlite3
 import logging
+import threading
 from pathlib import Path
 from contextlib import contextmanager
 from typing import Any, Generator
@@ -11,11 +14,20 @@ from config import DB_PATH
 
 log = logging.getLogger(__name__)
 
-SCHEMA_VERSION = 3  # 版本升级 v3 - 添加压缩字段
+# 设置该环境变量可覆盖默认数据库路径，例如测试时设为 ":memory:"
+DB_PATH_ENV = "CS_DB_PATH"
+MEMORY_DB = ":memory:"
+
+# 延迟写入：攒批后合并为一次提交
+WRITE_FLUSH_DELAY = 0.05  # 秒
+WRITE_FLUSH_THRESHOLD = 16  # 条
+
+SCHEMA_VERSION = 6  # v3 添加压缩字段, v4 api_call_log 覆盖索引, v5 schema_hash, v6 project+model 索引
 
 SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS schema_version (
-    version INTEGER NOT NULL
+    version INTEGER NOT NULL,
+    schema_hash TEXT
 );
 
 CREATE TABLE IF NOT EXISTS api_keys (
@@ -100,43 +112,186 @@ CREATE INDEX IF NOT EXISTS idx_documents_project ON documents(project_id);
 CREATE INDEX IF NOT EXISTS idx_conversations_project ON conversations(project_id);
 CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id);
 CREATE INDEX IF NOT EXISTS idx_messages_created ON messages(created_at);
-CREATE INDEX IF NOT EXISTS idx_api_log_project ON api_call_log(project_id, created_at DESC);
-CREATE INDEX IF NOT EXISTS idx_api_log_conversation ON api_call_log(conversation_id, created_at DESC);
+-- 覆盖索引：缓存命中率查询只需扫描索引，无需回表 (v4)
+CREATE INDEX IF NOT EXISTS idx_api_log_project ON api_call_log(
+    project_id, created_at DESC, cache_read_tokens, cache_creation_tokens, input_tokens);
+CREATE INDEX IF NOT EXISTS idx_api_log_conversation ON api_call_log(
+    conversation_id, created_at DESC, cache_read_tokens, cache_creation_tokens, input_tokens);
+-- 切换模型时按 (project_id, model_id) 取最近几次调用，直接走索引范围读 (v6)
+CREATE INDEX IF NOT EXISTS idx_api_log_project_model ON api_call_log(
+    project_id, model_id, created_at DESC, cache_read_tokens, cache_creation_tokens);
 """
 
+# SCHEMA_SQL 的指纹：与库中记录一致且版本相同时，启动跳过整段 DDL
+SCHEMA_HASH = hashlib.blake2b(SCHEMA_SQL.encode("utf-8"), digest_size=8).hexdigest()
+
+
 class Database:
     """SQLite database manager with connection pooling."""
 
-    def __init__(self, db_path: Path = DB_PATH) -> None:
-        self.db_path = db_path
+    def __init__(self, db_path: Path | str | None = None) -> None:
+        if db_path is None:
+            db_path = os.environ.get(DB_PATH_ENV) or DB_PATH
+        # ":memory:" 保持为字符串，其余统一为 Path
+        self._in_memory = str(db_path) == MEMORY_DB
+        self.db_path = MEMORY_DB if self._in_memory else Path(db_path)
         self._conn: sqlite3.Connection | None = None
+        self._tx_depth = 0  # transaction() 嵌套深度
+        # 连接跨线程共享（check_same_thread=False），所有访问经此锁串行化
+        self._lock = threading.RLock()
+        self._pending: list[tuple[str, tuple]] = []  # defer() 排队的写语句
+        self._flush_timer: threading.Timer | None = None
+        self._closed = False  # close() 之后不再自动重新打开连接
         log.info("Database path: %s", self.db_path)
 
     def _get_connection(self) -> sqlite3.Connection:
+        if self._closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
         if self._conn is None:
             self._conn = sqlite3.connect(
                 str(self.db_path),
                 check_same_thread=False,
                 timeout=10.0,
+                cached_statements=256,  # 按 SQL 文本缓存已编译语句
             )
             self._conn.row_factory = sqlite3.Row
-            self._conn.execute("PRAGMA journal_mode=WAL")
+            if not self._in_memory:  # WAL 需要磁盘文件
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                # WAL 下 NORMAL 仍保证一致性，只在 checkpoint 时 fsync
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
             self._conn.execute("PRAGMA foreign_keys=ON")
             log.debug("Database connection established")
         return self._conn
 
     @contextmanager
     def cursor(self) -> Generator[sqlite3.Cursor, None, None]:
-        """Get a database cursor within a transaction."""
-        conn = self._get_connection()
-        cur = conn.cursor()
+        """Get a database cursor within a transaction.
+
+        在 transaction() 内部时不单独提交，由最外层事务统一 COMMIT。
+        执行前先写入 defer() 排队的语句，保证读到自己的写入。
+        """
+        with self._lock:
+            if self._pending:
+                try:
+                    self.flush()
+                except Exception:
+                    # 排队写入的失败不应变成调用方读写的异常；队列保留，之后重试
+                    log.exception("Deferred write flush before query failed")
+            conn = self._get_connection()
+            cur = conn.cursor()
+            if self._tx_depth:
+                yield cur
+                return
+            try:
+                yield cur
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                log.exception("Database transaction failed, rolled back")
+                raise
+
+    @contextmanager
+    def transaction(self) -> Generator[None, None, None]:
+        """Group several writes into a single commit.
+
+        可嵌套：只有最外层执行 BEGIN IMMEDIATE / COMMIT，异常时整体回滚。
+        """
+        with self._lock:
+            conn = self._get_connection()
+            outermost = self._tx_depth == 0
+            if outermost and not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            self._tx_depth += 1
+            try:
+                yield
+            except Exception:
+                self._tx_depth -= 1
+                if outermost:
+                    conn.rollback()
+                    log.exception("Database transaction failed, rolled back")
+                raise
+            self._tx_depth -= 1
+            if outermost:
+                conn.commit()
+
+    def defer(self, sql: str, params: tuple = ()) -> None:
+        """Queue a write; queued writes are committed together by flush().
+
+        满 WRITE_FLUSH_THRESHOLD 条立即写入，否则 WRITE_FLUSH_DELAY 秒后由后台
+        定时器写入；任何读写操作之前也会先写入队列中的语句。
+        """
+        with self._lock:
+            if self._closed:
+                log.error("Database closed, deferred write lost: %s", sql)
+                return
+            self._pending.append((sql, params))
+            if len(self._pending) >= WRITE_FLUSH_THRESHOLD:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(WRITE_FLUSH_DELAY, self._timer_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self) -> None:
+        """Commit all deferred writes in one transaction (consecutive identical SQL via executemany).
+
+        提交成功后才清空队列。OperationalError（库被锁、磁盘 I/O 等）时整批保留，
+        由下一次读写/flush 重试；其他错误（约束冲突等）时逐条重放，只丢弃失败的那几条。
+        """
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            batch = self._pending
+            if not batch or self._closed:
+                return
+            conn = self._get_connection()
+            try:
+                with self.transaction():
+                    i = 0
+                    while i < len(batch):
+                        sql = batch[i][0]
+                        j = i
+                        while j < len(batch) and batch[j][0] == sql:
+                            j += 1
+                        conn.executemany(sql, [params for _, params in batch[i:j]])
+                        i = j
+            except sqlite3.OperationalError:
+                log.error("Failed to flush %d deferred writes, kept for retry", len(batch))
+                raise
+            except Exception:
+                log.warning("Batch flush of %d deferred writes failed, replaying one by one", len(batch))
+                self._replay_pending(conn)
+                return
+            self._pending = []
+            log.debug("Flushed %d deferred writes", len(batch))
+
+    def _replay_pending(self, conn: sqlite3.Connection) -> None:
+        """Commit queued writes one per transaction, dropping only the ones that fail.
+
+        一条坏语句（如约束冲突）不会连带丢失同批其他对话的消息/日志行。
+        遇到 OperationalError 时停止，未写入的部分留在队列中等待重试。
+        """
+        batch = self._pending
+        for n, (sql, params) in enumerate(batch):
+            try:
+                with self.transaction():
+                    conn.execute(sql, params)
+            except sqlite3.OperationalError:
+                self._pending = batch[n:]
+                log.error("Failed to flush %d deferred writes, kept for retry", len(self._pending))
+                raise
+            except Exception:
+                log.exception("Dropped deferred write that cannot be applied: %s", sql)
+        self._pending = []
+
+    def _timer_flush(self) -> None:
+        """Background-timer flush: failures are logged, never raised on the timer thread."""
         try:
-            yield cur
-            conn.commit()
+            self.flush()
         except Exception:
-            conn.rollback()
-            log.exception("Database transaction failed, rolled back")
-            raise
+            log.exception("Deferred write flush failed")
 
     def execute(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
         """Execute SQL and return all rows."""
@@ -144,6 +299,16 @@ class Database:
             cur.execute(sql, params)
             return cur.fetchall()
 
+    def execute_tuples(self, sql: str, params: tuple = ()) -> list[tuple]:
+        """Execute SQL and return plain tuples (hot read paths).
+
+        绕过 sqlite3.Row 的按列名查找，调用方按 SELECT 列顺序做位置索引。
+        """
+        with self.cursor() as cur:
+            cur.row_factory = None
+            cur.execute(sql, params)
+            return cur.fetchall()
+
     def execute_one(self, sql: str, params: tuple = ()) -> sqlite3.Row | None:
         """Execute SQL and return one row or None."""
         with self.cursor() as cur:
@@ -165,28 +330,46 @@ class Database:
     def initialize(self) -> None:
         """Create tables and run migrations."""
         log.info("Initializing database schema (version %d)", SCHEMA_VERSION)
+        if self._schema_is_current():
+            log.info("Schema version: %d (hash %s, unchanged)", SCHEMA_VERSION, SCHEMA_HASH)
+            return
+
         conn = self._get_connection()
         conn.executescript(SCHEMA_SQL)
 
         row = self.execute_one("SELECT version FROM schema_version LIMIT 1")
         if row is None:
-            self.execute("INSERT INTO schema_version (version) VALUES (?)", (SCHEMA_VERSION,))
+            self.execute("INSERT INTO schema_version (version, schema_hash) VALUES (?, ?)",
+                         (SCHEMA_VERSION, SCHEMA_HASH))
             log.info("Schema version set to %d", SCHEMA_VERSION)
         else:
             current = row["version"]
             if current < SCHEMA_VERSION:
                 self._migrate(current, SCHEMA_VERSION)
-                self.execute("UPDATE schema_version SET version = ?", (SCHEMA_VERSION,))
                 log.info("Schema migrated from %d to %d", current, SCHEMA_VERSION)
             else:
                 log.info("Schema version: %d", current)
+            self.execute("UPDATE schema_version SET version = ?, schema_hash = ?",
+                         (max(current, SCHEMA_VERSION), SCHEMA_HASH))
+
+    def _schema_is_current(self) -> bool:
+        """True if the stored version and SCHEMA_SQL hash both match this build."""
+        try:
+            # 直接走连接，避免 cursor() 把预期内的失败记录成事务错误
+            row = self._get_connection().execute(
+                "SELECT version, schema_hash FROM schema_version LIMIT 1"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            # 新库（表不存在）或 v5 之前的库（缺少 schema_hash 列）
+            return False
+        return row is not None and row["version"] == SCHEMA_VERSION and row["schema_hash"] == SCHEMA_HASH
 
     def _migrate(self, from_ver: int, to_ver: int) -> None:
         """Run schema migrations between versions."""
         log.info("Migrating schema from v%d to v%d", from_ver, to_ver)
         
         # PRD v3: 备份数据库再迁移 (防止数据丢失)
-        if from_ver < to_ver and self._conn:
+        if from_ver < to_ver and self._conn and not self._in_memory:
             import shutil
             import datetime
             backup_path = self.db_path.with_suffix(f'.db.backup_v{from_ver}.{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}')
@@ -226,12 +409,55 @@ class Database:
             self.execute("ALTER TABLE conversations ADD COLUMN compress_after_turns INTEGER DEFAULT 10")
             log.info("Migration to v3: Added compression fields to conversations table")
 
+        if from_ver < 4:
+            # api_call_log 索引改为覆盖索引（带上缓存统计列）
+            self.execute("DROP INDEX IF EXISTS idx_api_log_project")
+            self.execute("DROP INDEX IF EXISTS idx_api_log_conversation")
+            self.execute(
+                "CREATE INDEX idx_api_log_project ON api_call_log("
+                "project_id, created_at DESC, cache_read_tokens, cache_creation_tokens, input_tokens)"
+            )
+            self.execute(
+                "CREATE INDEX idx_api_log_conversation ON api_call_log("
+                "conversation_id, created_at DESC, cache_read_tokens, cache_creation_tokens, input_tokens)"
+            )
+            log.info("Migration to v4: Rebuilt api_call_log indexes as covering indexes")
+
+        if from_ver < 5:
+            # 记录 SCHEMA_SQL 指纹，用于启动时跳过 DDL
+            self.execute("ALTER TABLE schema_version ADD COLUMN schema_hash TEXT")
+            log.info("Migration to v5: Added schema_hash to schema_version")
+
+        if from_ver < 6:
+            # 模型切换时的缓存命中查询按 project_id + model_id 过滤
+            self.execute(
+                "CREATE INDEX IF NOT EXISTS idx_api_log_project_model ON api_call_log("
+                "project_id, model_id, created_at DESC, cache_read_tokens, cache_creation_tokens)"
+            )
+            log.info("Migration to v6: Added api_call_log (project_id, model_id) index")
+
     def close(self) -> None:
-        """Close the database connection."""
-        if self._conn:
-            self._conn.close()
-            self._conn = None
-            log.debug("Database connection closed")
+        """Flush deferred writes and close the database connection.
+
+        即使写入失败也会关闭连接；关闭后不再自动重新打开，排队中的定时写入随之取消。
+        """
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Failed to flush %d deferred writes on close, lost", len(self._pending))
+            finally:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                self._pending = []
+                self._closed = True
+                if self._conn:
+                    self._conn.close()
+                    self._conn = None
+                    log.debug("Database connection closed")
 
 # Singleton
 db = Database()
\ No newline at end of file
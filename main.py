@@ -9,6 +9,11 @@ import logging
 import json
 from pathlib import Path
 
+try:
+    import orjson  # 可选：比 json 更快的 C 实现
+except ImportError:
+    orjson = None
+
 # Must configure logging before any other imports
 from config import setup_logging, APP_NAME, APP_VERSION, LOG_PATH
 
@@ -24,8 +29,9 @@ def load_theme_config() -> dict:
     """Load theme configuration from file."""
     try:
         if THEME_CONFIG_FILE.exists():
-            with open(THEME_CONFIG_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            # 一次性读取字节再解析，避免 json.load 的逐块文本解码
+            raw = THEME_CONFIG_FILE.read_bytes()
+            return orjson.loads(raw) if orjson else json.loads(raw)
     except Exception:
         pass
     return {"mode": "dark"}
@@ -35,12 +41,33 @@ def save_theme_config(config: dict) -> None:
     """Save theme configuration to file."""
     try:
         THEME_CONFIG_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(THEME_CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
+        if orjson:
+            data = orjson.dumps(config, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(config, ensure_ascii=False, indent=2).encode("utf-8")
+        THEME_CONFIG_FILE.write_bytes(data)
     except Exception:
         pass
 
 
+def _check_anthropic() -> None:
+    """Import the anthropic SDK after the window is up and log its version.
+
+    anthropic 会连带导入 httpx / pydantic 等，放到窗口显示之后避免拖慢冷启动。
+    """
+    try:
+        import anthropic
+        log.info("anthropic SDK version: %s", anthropic.__version__)
+    except ImportError:
+        from PySide6.QtWidgets import QApplication, QMessageBox
+        log.error("anthropic SDK not installed")
+        print("\n[ERROR] anthropic SDK not installed.")
+        print("  Run: pip install anthropic\n")
+        QMessageBox.critical(None, APP_NAME,
+                             "anthropic SDK not installed.\n\nRun: pip install anthropic")
+        QApplication.exit(1)
+
+
 def main():
     log.info("=" * 60)
     log.info("%s v%s starting", APP_NAME, APP_VERSION)
@@ -67,16 +94,6 @@ def main():
         print("  Run: pip install PySide6 PySide6-Addons\n")
         sys.exit(1)
 
-    # Check for anthropic
-    try:
-        import anthropic
-        log.info("anthropic SDK version: %s", anthropic.__version__)
-    except ImportError:
-        log.error("anthropic SDK not installed")
-        print("\n[ERROR] anthropic SDK not installed.")
-        print("  Run: pip install anthropic\n")
-        sys.exit(1)
-
     # Enable High DPI scaling
     QApplication.setHighDpiScaleFactorRoundingPolicy(
         Qt.HighDpiScaleFactorRoundingPolicy.PassThrough
@@ -87,22 +104,26 @@ def main():
     app.setApplicationVersion(APP_VERSION)
 
     # PRD v3 §8.5: 支持亮色/暗色主题
-    from utils.theme_manager import LIGHT_THEME, DARK_THEME
-    
-    theme_config = load_theme_config()
-    theme_mode = theme_config.get("mode", "dark")
-    
-    # 根据保存的配置应用主题
-    if theme_mode == "light":
-        app.setStyleSheet(LIGHT_THEME)
-    else:
-        app.setStyleSheet(DARK_THEME)
+    from utils.theme_manager import get_theme
+
+    # 根据保存的配置应用主题（只取所选主题）
+    theme_mode = load_theme_config().get("mode", "dark")
+    app.setStyleSheet(get_theme(theme_mode))
+
+    # 后台预热 tiktoken 编码器，首次 token 估算不再阻塞 UI
+    import threading
+    from core.token_tracker import prewarm_encoder
+    threading.Thread(target=prewarm_encoder, name="tiktoken-prewarm", daemon=True).start()
 
     # Create and show main window
     from ui.main_window import MainWindow
     window = MainWindow()
     window.show()
 
+    # Check for anthropic (deferred until the window is visible)
+    from PySide6.QtCore import QTimer
+    QTimer.singleShot(0, _check_anthropic)
+
     log.info("Application ready")
     sys.exit(app.exec())
 
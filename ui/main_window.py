@@ -1,35 +1,59 @@
 """Main application window with three-panel layout."""
 from __future__ import annotations
-from utils.markdown_renderer import render_markdown, get_chat_html_template, escape_js_string
 import os
 import sys
-import base64
+import binascii
 import json
+import html as html_mod
 import time
+import threading
 import logging
+import queue
 import atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from functools import partial
+from functools import partial, lru_cache
+from operator import attrgetter
+from bisect import bisect_right
+from types import MappingProxyType
+from collections import OrderedDict
+from contextlib import contextmanager
 import re
 
 # #region agent log
 DEBUG_LOG_PATH = r"c:\Users\Think\Desktop\ClaudeStation\claude_station\.cursor\debug.log"
+# 调试日志经队列交给后台线程写文件，UI 线程不再逐条 open/write
+_dbg_log = logging.getLogger("agent_debug")
+_dbg_log.propagate = False
+_dbg_log.setLevel(logging.DEBUG)
+if os.path.isdir(os.path.dirname(DEBUG_LOG_PATH)):
+    _dbg_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _dbg_listener = QueueListener(_dbg_queue, RotatingFileHandler(
+        DEBUG_LOG_PATH, maxBytes=2_000_000, backupCount=3, encoding="utf-8", delay=True,
+    ))
+    _dbg_listener.start()
+    atexit.register(_dbg_listener.stop)
+    _dbg_log.addHandler(QueueHandler(_dbg_queue))
+else:
+    _dbg_log.disabled = True
+
 def _dlog(location, message, data=None, hypothesis_id=None):
-    try:
-        with open(DEBUG_LOG_PATH, "a", encoding="utf-8") as f:
-            f.write(json.dumps({"id": "log_%s" % int(time.time()*1000), "timestamp": int(time.time()*1000), "location": location, "message": message, "data": data or {}, "hypothesisId": hypothesis_id or ""}) + "\n")
-    except Exception:
-        pass
+    if _dbg_log.disabled:
+        return
+    ts = time.time_ns() // 1_000_000
+    _dbg_log.debug(_jdumps({"id": "log_%s" % ts, "timestamp": ts, "location": location, "message": message, "data": data or {}, "hypothesisId": hypothesis_id or ""}))
 # #endregion
 
 from PySide6.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QSplitter,
-    QListWidget, QListWidgetItem, QPushButton, QLabel, QComboBox,
+    QListWidget, QPushButton, QLabel, QComboBox,
     QTextEdit, QPlainTextEdit, QLineEdit, QFileDialog, QMessageBox,
     QInputDialog, QMenu, QFrame, QToolButton, QStatusBar, QSlider,
     QCheckBox, QApplication, QAbstractItemView,
 )
-from PySide6.QtCore import Qt, QThread, Signal, Slot, QTimer, QSize
+from PySide6.QtCore import (
+    Qt, Signal, Slot, QTimer, QSize, QRunnable, QThreadPool, QSignalBlocker,
+)
 from PySide6.QtGui import QAction, QKeySequence, QIcon, QFont, QShortcut
 from PySide6.QtWebEngineWidgets import QWebEngineView
 from PySide6.QtWebEngineCore import QWebEnginePage
@@ -44,17 +68,195 @@ from core.project_manager import ProjectManager, Project
 from core.conversation_manager import ConversationManager, Conversation, Message
 from core.document_processor import DocumentProcessor
 from core.context_builder import ContextBuilder
-from core.context_compressor import ContextCompressor, CompressionWorker
+from core.context_compressor import ContextCompressor
 from core.token_tracker import TokenTracker, UsageInfo
 from api.claude_client import ClaudeClient, StreamEvent
 from utils.key_manager import KeyManager
-from utils.markdown_renderer import render_markdown, get_chat_html_template
+from utils.markdown_renderer import (
+    render_markdown, get_chat_html_template, StreamRenderCache, prewarm as prewarm_markdown,
+)
 from ui.settings_dialog import SettingsDialog
 from data.database import db
 
 log = logging.getLogger(__name__)
 
 
+@contextmanager
+def _bulk(widget):
+    """批量刷新列表：暂停重绘并屏蔽信号，结束后只重绘一次。"""
+    widget.setUpdatesEnabled(False)
+    widget.blockSignals(True)
+    try:
+        yield widget
+    finally:
+        widget.blockSignals(False)
+        widget.setUpdatesEnabled(True)
+        widget.update()
+
+
+# 模型下拉框条目 (显示文本, model_id)，导入时计算一次
+_MODEL_ITEMS = tuple(
+    (f"{m.display_name} ${m.input_price}/${m.output_price}", mid)
+    for mid, m in MODELS.items()
+)
+# ── 热路径 SQL：固定文本，命中 sqlite3 连接的语句缓存，不重复解析 ──────────────
+_RECENT_CACHE_SQL = """
+    SELECT cache_read_tokens, cache_creation_tokens
+    FROM api_call_log
+    WHERE project_id = ? AND model_id = ?
+    ORDER BY created_at DESC LIMIT 5
+"""
+
+# thinking 预算建议：输入长度 < 阈值[i] 时取 _THINKING_BUDGETS[i]，超过全部阈值取最后一项
+_THINKING_THRESHOLDS = (200, 1000, 3000)
+_THINKING_BUDGETS = (
+    (1024, "短问题，快速推理即可"),
+    (2048, "中等复杂度，标准分析"),
+    (4096, "较长内容，建议深度思考"),
+    (8192, "复杂长文本，需要充分推理"),
+)
+
+# 4 层缓存仪表盘保留的预估结果数
+_ESTIMATE_CACHE_SIZE = 32
+
+# 切换对话时每批注入页面的历史消息数
+_HISTORY_CHUNK = 20
+
+try:
+    import re2 as _uid_re  # 可选：google-re2 线性时间匹配，未安装时退回标准库 re
+except ImportError:
+    _uid_re = re
+
+# 显式引用语法 @#uid（8 位 hex 或完整 UUID），模块加载时编译一次
+_UID_REF_RE = _uid_re.compile(
+    r"@#([0-9a-fA-F]{8}(?:(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12})?)"
+)
+
+# model_id -> 下拉框索引，替代 findData 线性扫描
+_MODEL_INDEX = {mid: i for i, (_, mid) in enumerate(_MODEL_ITEMS)}
+
+
+try:
+    import orjson  # 可选：C 实现的 JSON 编码，未安装时退回标准库
+
+    def _jdumps(obj) -> str:
+        """Compact JSON text for runJavaScript payloads and debug records."""
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _jdumps(obj) -> str:
+        """Compact JSON text for runJavaScript payloads and debug records."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _js_str(s: str) -> str:
+    """Encode s as a JavaScript string literal (quotes included) for runJavaScript."""
+    return _jdumps(s)
+
+
+# ── 主题颜色 ────────────────────────────────────────────────────────────────
+THEME_CONFIG_FILE = Path.home() / "ClaudeStation" / "theme_config.json"
+
+_TOP_BAR_QSS_TMPL = """
+    QFrame { background: %(top_bar_bg)s; border-bottom: 1px solid %(top_bar_border)s; padding: 4px; }
+    QLabel { color: %(label)s; font-size: 13px; }
+"""
+_INPUT_FRAME_QSS_TMPL = """
+    QFrame { background: %(input_bg)s; border-top: 1px solid %(input_border)s; }
+"""
+
+
+def _themed(colors: dict) -> MappingProxyType:
+    """Colors plus the theme-dependent stylesheets, formatted once at import."""
+    return MappingProxyType({
+        **colors,
+        "top_bar_qss": _TOP_BAR_QSS_TMPL % colors,
+        "input_frame_qss": _INPUT_FRAME_QSS_TMPL % colors,
+    })
+
+
+_DARK_COLORS = _themed({
+    "top_bar_bg": "#252525", "top_bar_border": "#3A3A3A", "label": "#AAAAAA",
+    "input_bg": "#252525", "input_border": "#3A3A3A",
+})
+_LIGHT_COLORS = _themed({
+    "top_bar_bg": "#F5F5F0", "top_bar_border": "#CCCCCC", "label": "#1A1A1A",
+    "input_bg": "#FFFFFF", "input_border": "#DDDDDD",
+})
+
+# ── 固定样式表（与主题无关），构建界面时直接复用 ─────────────────────────────
+_SEARCH_BAR_QSS = "QFrame { background: #2A2A2A; border-bottom: 1px solid #3A3A3A; padding: 4px; }"
+_SEARCH_BOX_QSS = (
+    "QLineEdit { background: #3A3A3A; color: #E5E5E5; border: 1px solid #555; "
+    "border-radius: 4px; padding: 4px 8px; }"
+    "QLineEdit:focus { border-color: #D97706; }"
+)
+_SEARCH_BTN_QSS = (
+    "QPushButton { background: #3A3A3A; color: #AAA; border: 1px solid #555; border-radius: 4px; }"
+    "QPushButton:hover { background: #454545; color: #FFF; }"
+)
+_CLOSE_SEARCH_BTN_QSS = (
+    "QPushButton { background: transparent; color: #888; border: none; font-size: 14px; }"
+    "QPushButton:hover { color: #E74C3C; }"
+)
+_NEW_BTN_QSS = (
+    "QPushButton { font-size: 12px; font-weight: bold; color: #E5E5E5; "
+    "background: #3A3A3A; border: 1px solid #555; border-radius: 4px; min-width: 72px; }"
+    "QPushButton:hover { background: #454545; }"
+)
+_HINT_LABEL_QSS = "color: #888; font-size: 11px;"
+# 附件 chip：规则挂在 chip 容器上解析一次，chip 只设置 objectName
+_ATTACH_CHIPS_QSS = (
+    "QFrame#attachChip { background: #3A3A3A; border-radius: 4px; padding: 2px 6px; }"
+    "QLabel#attachChipLabel { color: #CCC; font-size: 11px; max-width: 200px; }"
+    "QPushButton#attachChipRemove { color: #AAA; font-size: 16px; font-weight: bold; "
+    "background: transparent; border: 1px solid #555; border-radius: 4px; }"
+    "QPushButton#attachChipRemove:hover { color: #E74C3C; border-color: #E74C3C; background: #3A2020; }"
+)
+
+# 4 层缓存仪表盘：(标签前缀, 颜色)，L1..L4 依次排列
+_LAYER_SPECS = (
+    ("L1: System+Docs", "#4CAF50"),
+    ("L2: Summary", "#2196F3"),
+    ("L3: Recent", "#FF9800"),
+    ("L4: Current", "#9C27B0"),
+)
+_LAYER_QSS = "color: %s; font-size: 11px;"
+_LAYER_CACHED_QSS = _LAYER_QSS % "#4CAF50"    # 绿色 = 缓存
+_LAYER_UNCACHED_QSS = _LAYER_QSS % "#FF9800"  # 橙色 = 未缓存
+
+
+@lru_cache(maxsize=1)
+def _theme_colors() -> MappingProxyType:
+    """Widget colors for the configured theme; theme_config.json is read once."""
+    try:
+        if THEME_CONFIG_FILE.exists():
+            theme_data = json.loads(THEME_CONFIG_FILE.read_text(encoding="utf-8"))
+            if theme_data.get("mode") == "light":
+                return _LIGHT_COLORS
+    except Exception:
+        pass
+    return _DARK_COLORS
+
+
+# ── 快捷键表：(按键, MainWindow 上的槽属性路径) ─────────────────────────────
+_ESCAPE_KEY = "Escape"
+_SHORTCUT_SPECS = (
+    ("Ctrl+Return", "_send_message"),
+    ("Ctrl+N", "_new_conversation"),
+    ("Ctrl+Shift+N", "_new_project"),
+    ("Ctrl+,", "_open_settings"),
+    ("Ctrl+L", "input_box.setFocus"),
+    (_ESCAPE_KEY, "_cancel_streaming"),
+    ("Ctrl+F", "_toggle_search"),  # PRD v3 §8.6: 对话内搜索
+)
+
+
+@lru_cache(maxsize=1)
+def _shortcuts() -> tuple:
+    """QKeySequence 只解析一次（需在 QApplication 创建后调用）。"""
+    return tuple((key, QKeySequence(key), attrgetter(slot)) for key, slot in _SHORTCUT_SPECS)
+
+
 # ── App State File (for persisting last conversation) ───────────────────────
 APP_STATE_FILE = Path.home() / APP_NAME / "app_state.json"
 
@@ -69,19 +271,30 @@ def _load_app_state() -> dict:
     return {}
 
 def _save_app_state(state: dict) -> None:
-    """Save app state to JSON file."""
+    """Save app state to JSON file (write temp file, then atomic replace)."""
     try:
         APP_STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(APP_STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        tmp = APP_STATE_FILE.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, APP_STATE_FILE)
     except Exception:
         pass
 
-# Register save on exit
-atexit.register(lambda: _save_app_state(_app_state_cache))
-
 # In-memory cache for app state
 _app_state_cache: dict = {}
+_app_state_dirty = False  # 有未写盘的修改
+APP_STATE_FLUSH_MS = 500  # 合并写盘的延迟
+
+def _flush_app_state() -> None:
+    """Write app state if it changed since the last write."""
+    global _app_state_dirty
+    if _app_state_dirty:
+        _app_state_dirty = False
+        _save_app_state(_app_state_cache)
+
+# Register save on exit (only when there are unsaved changes)
+atexit.register(_flush_app_state)
 
 def _get_app_state() -> dict:
     """Get cached app state, loading if needed."""
@@ -91,20 +304,37 @@ def _get_app_state() -> dict:
     return _app_state_cache
 
 def _set_app_state_value(key: str, value) -> None:
-    """Set a value in app state and persist."""
-    global _app_state_cache
+    """Set a value in app state; the file is written once per APP_STATE_FLUSH_MS burst."""
+    global _app_state_dirty
     state = _get_app_state()
+    if key in state and state[key] == value:
+        return
     state[key] = value
-    _app_state_cache = state
-    _save_app_state(state)
+    if not _app_state_dirty:
+        _app_state_dirty = True
+        QTimer.singleShot(APP_STATE_FLUSH_MS, _flush_app_state)
 
 
 class ChatBridge(QObject):
-    """Exposed to chat page via QWebChannel: insert ref text into input."""
+    """Exposed to chat page via QWebChannel: insert ref text into input.
+
+    流式更新通过 streamUpdated 信号推送，页面端一次性订阅，
+    无需每个 delta 都经 runJavaScript 拼接/解析脚本。
+    """
+
+    # (流 id，新稳定片段 HTML，空串表示无新增；当前尾部 HTML)
+    streamUpdated = Signal(int, str, str)
+    # (流 id, thinking_html, final_html, meta, uid, raw_markdown)，页面端调用 finalizeMessage
+    streamFinished = Signal(int, str, str, str, str, str)
 
     def __init__(self, main_window: "MainWindow", parent=None):
         super().__init__(parent)
         self._main_window = main_window
+        self.ready = False  # 页面端 QWebChannel 已连接
+
+    @Slot()
+    def channelReady(self) -> None:
+        self.ready = True
 
     @Slot(str)
     def insertRef(self, text: str) -> None:
@@ -123,9 +353,6 @@ class ChatBridge(QObject):
     @Slot(str, str)
     def downloadMarkdown(self, content: str, filename: str) -> None:
         """Download Markdown content as a file."""
-        from pathlib import Path
-        from PySide6.QtWidgets import QFileDialog
-        
         # 使用用户建议的默认文件名
         default_name = filename if filename else "document.md"
         
@@ -137,12 +364,11 @@ class ChatBridge(QObject):
         )
         
         if path:
-            try:
-                Path(path).write_text(content, encoding="utf-8")
-                self._main_window.statusBar().showMessage(f"已保存: {path}", 3000)
-            except Exception as e:
-                log.error("Failed to save markdown file: %s", e)
-                self._main_window.statusBar().showMessage(f"保存失败: {str(e)}", 3000)
+            # 写文件放到线程池，大段内容也不阻塞界面；结果经信号回到状态栏
+            mw = self._main_window
+            QThreadPool.globalInstance().start(
+                _WriteTask(path, content, mw.file_saved, mw.file_save_failed)
+            )
 
 
 class ChatWebPage(QWebEnginePage):
@@ -155,19 +381,41 @@ class ChatWebPage(QWebEnginePage):
         self._channel = QWebChannel(self)
         self._channel.registerObject("chatHost", self._bridge)
         self.setWebChannel(self._channel)
+        # setHtml 重新加载页面后需等待 JS 端重新订阅
+        self.loadStarted.connect(self._on_load_started)
+
+    @property
+    def bridge(self) -> ChatBridge:
+        return self._bridge
+
+    def _on_load_started(self):
+        self._bridge.ready = False
 
 
-class APIWorker(QThread):
-    """Background thread for API calls."""
+# 工作线程端合并增量：至多每 1/30 秒向 UI 线程投递一次（与页面刷新节奏一致）
+STREAM_EMIT_INTERVAL = 1 / 30  # 秒
+
+
+class _APIWorkerSignals(QObject):
+    """Signals for APIWorker (QRunnable itself cannot carry signals)."""
     text_delta = Signal(str)
     thinking_delta = Signal(str)
     finished = Signal(str, str, object)
     error = Signal(str)
 
+
+class APIWorker(QRunnable):
+    """Streams one API response on a pooled thread.
+
+    线程来自 MainWindow 常驻的单线程池，每条消息不再创建/销毁 OS 线程。
+    """
+
     def __init__(self, client: ClaudeClient, messages: list, system: list,
                  model: str, max_tokens: int, thinking: dict | None = None,
                  project_id: str = "", conversation_id: str = ""):
         super().__init__()
+        self.setAutoDelete(False)  # 生命周期由 MainWindow.worker 持有
+        self.signals = _APIWorkerSignals()
         self.client = client
         self.messages = messages
         self.system = system
@@ -176,12 +424,39 @@ class APIWorker(QThread):
         self.thinking_cfg = thinking
         self.project_id = project_id
         self.conversation_id = conversation_id
-        self._cancelled = False
+        self._cancelled = threading.Event()
+        self._done = False
+
+    def isRunning(self) -> bool:
+        """True from submission until run() returns (queued counts as running)."""
+        return not self._done
 
     def run(self):
-        full_text = ""
-        thinking_text = ""
+        try:
+            self._stream()
+        finally:
+            self._done = True
+
+    def _stream(self):
+        text_parts: list[str] = []  # 只发送增量，全文在结束时拼接一次
+        full_text = None
+        thinking_parts: list[str] = []
         usage = None
+        # 尚未投递给 UI 的增量；每个信号都是一次跨线程事件，攒够一帧再发
+        pending_text: list[str] = []
+        pending_thinking: list[str] = []
+        last_emit = time.monotonic()
+
+        def emit_pending():
+            nonlocal last_emit
+            if pending_thinking:
+                self.signals.thinking_delta.emit("".join(pending_thinking))
+                pending_thinking.clear()
+            if pending_text:
+                self.signals.text_delta.emit("".join(pending_text))
+                pending_text.clear()
+            last_emit = time.monotonic()
+
         try:
             for event in self.client.stream_message(
                 messages=self.messages,
@@ -192,35 +467,398 @@ class APIWorker(QThread):
                 project_id=self.project_id,
                 conversation_id=self.conversation_id,
             ):
-                if self._cancelled:
+                if self._cancelled.is_set():
                     log.info("Streaming cancelled by user")
                     break
                 if event.type == "text":
-                    full_text += event.text
-                    self.text_delta.emit(full_text)
+                    text_parts.append(event.text)
+                    pending_text.append(event.text)
                 elif event.type == "thinking":
-                    thinking_text += event.text
-                    self.thinking_delta.emit(event.text)
+                    thinking_parts.append(event.text)
+                    pending_thinking.append(event.text)
                 elif event.type == "error":
-                    self.error.emit(event.error)
+                    emit_pending()
+                    self.signals.error.emit(event.error)
                     return
                 elif event.type == "done":
                     full_text = event.text
                     usage = event.usage
+                if time.monotonic() - last_emit >= STREAM_EMIT_INTERVAL:
+                    emit_pending()
         except Exception as e:
             log.exception("Worker thread exception")
-            self.error.emit(str(e))
+            emit_pending()
+            self.signals.error.emit(str(e))
             return
 
-        self.finished.emit(full_text, thinking_text, usage)
+        emit_pending()
+
+        if full_text is None:  # 取消或未收到 done 事件
+            full_text = "".join(text_parts)
+        self.signals.finished.emit(full_text, "".join(thinking_parts), usage)
 
     def cancel(self):
-        self._cancelled = True
+        self._cancelled.set()
+
+
+class _ProjectLoadTask(QRunnable):
+    """在线程池中读取项目列表，通过信号交回 UI 线程。"""
+
+    def __init__(self, project_mgr: ProjectManager, done_signal):
+        super().__init__()
+        self._project_mgr = project_mgr
+        self._done_signal = done_signal
+
+    def run(self):
+        try:
+            projects = self._project_mgr.list_all()
+        except Exception:
+            log.exception("Failed to load projects")
+            projects = []
+        self._done_signal.emit(projects)
+
+
+class _ClientInitTask(QRunnable):
+    """在线程池中读取默认 API key 并配置客户端（导入 anthropic/httpx 需要数百毫秒）。"""
+
+    def __init__(self, key_manager: KeyManager, client: ClaudeClient, done_signal):
+        super().__init__()
+        self._key_manager = key_manager
+        self._client = client
+        self._done_signal = done_signal
+
+    def run(self):
+        try:
+            default = self._key_manager.get_default_key()
+            if not default:
+                log.warning("No API key found")
+                self._done_signal.emit("⚠ No API key configured - open Settings")
+                return
+            _, key = default
+            self._client.configure(key)
+        except ImportError as e:
+            log.error("Anthropic SDK unavailable: %s", e)
+            self._done_signal.emit(f"⚠ API client unavailable: {e}")
+            return
+        except Exception as e:
+            log.exception("Failed to initialize API client")
+            self._done_signal.emit(f"⚠ API client init failed: {e}")
+            return
+        log.info("Client initialized with default API key")
+        self._done_signal.emit("API key loaded")
+
+
+class _MarkdownPrewarmTask(QRunnable):
+    """在线程池中预先导入 markdown/pygments 并解析一次，首条消息渲染无需再等待导入。"""
+
+    def run(self):
+        try:
+            prewarm_markdown()
+        except Exception:
+            log.debug("Markdown prewarm failed", exc_info=True)
+
+
+class _DocUploadTask(QRunnable):
+    """在线程池中解析并入库单个文档（PDF/DOCX 解析与 token 计数较慢）。"""
+
+    def __init__(self, doc_processor: DocumentProcessor, project_id: str, path: str,
+                 done_signal, failed_signal):
+        super().__init__()
+        self._doc_processor = doc_processor
+        self._project_id = project_id
+        self._path = path
+        self._done_signal = done_signal
+        self._failed_signal = failed_signal
+
+    def run(self):
+        try:
+            result = self._doc_processor.add_document(self._project_id, self._path)
+        except Exception as e:
+            log.exception("Upload failed: %s", self._path)
+            self._failed_signal.emit(self._path, str(e))
+            return
+        self._done_signal.emit(result)
+
+
+# 附件后缀 -> (附件类型, media_type)
+_ATTACH_TYPES = MappingProxyType({
+    ".png": ("image", "image/png"),
+    ".jpg": ("image", "image/jpeg"),
+    ".jpeg": ("image", "image/jpeg"),
+    ".gif": ("image", "image/gif"),
+    ".webp": ("image", "image/webp"),
+    ".pdf": ("document", "application/pdf"),
+    ".txt": ("document", "text/plain"),
+    ".md": ("document", "text/markdown"),
+    ".markdown": ("document", "text/markdown"),
+    ".doc": ("document", "application/msword"),
+    ".docx": ("document", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    ".xlsx": ("document", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ".xls": ("document", "application/vnd.ms-excel"),
+    ".csv": ("document", "text/csv"),
+    ".json": ("document", "application/json"),
+    ".html": ("document", "text/html"),
+    ".rtf": ("document", "application/rtf"),
+})
+
+# 附件对话框过滤器，"All supported" 与 _ATTACH_TYPES 保持一致
+_ATTACH_FILTER = (
+    f"All supported ({' '.join('*' + ext for ext in _ATTACH_TYPES)});;"
+    "Images (*.png *.jpg *.jpeg *.gif *.webp);;"
+    "PDF (*.pdf);;"
+    "Text / Markdown (*.txt *.md *.markdown);;"
+    "Word (*.doc *.docx);;"
+    "Excel (*.xlsx *.xls);;"
+    "CSV (*.csv);;"
+    "Other (*.json *.html *.rtf);;"
+    "All Files (*)"
+)
+_UPLOAD_FILTER = (
+    "All Supported (*.pdf *.docx *.txt *.md *.csv *.py *.js *.ts *.json *.xlsx *.xml *.yaml *.yml "
+    "*.html *.css *.java *.c *.cpp *.go *.rs *.rb *.sql);;All Files (*)"
+)
+
+_MD_CACHE_SIZE = 512  # 按消息 id 缓存的渲染 HTML 条数（LRU）
+_ATTACH_CACHE_SIZE = 32  # 已编码附件缓存条数（LRU）
+
+_B64_CHUNK = 48 * 1024  # 3 的倍数，分块编码结果与整体编码一致（无中间填充）
+
+
+def _b64_file(path: str) -> str:
+    """Base64-encode a file chunk by chunk (never holds the whole raw file in memory)."""
+    buf = bytearray()
+    with open(path, "rb") as f:
+        while chunk := f.read(_B64_CHUNK):
+            buf += binascii.b2a_base64(chunk, newline=False)
+    return buf.decode("ascii")
+
+
+class _AttachEncodeTask(QRunnable):
+    """在线程池中读取并 base64 编码附件，大图片不阻塞 UI 线程。"""
+
+    def __init__(self, path: str, attachment: dict, cache_key: tuple, seq: int,
+                 done_signal, failed_signal):
+        super().__init__()
+        self._path = path
+        self._attachment = attachment
+        self._cache_key = cache_key
+        self._seq = seq
+        self._done_signal = done_signal
+        self._failed_signal = failed_signal
+
+    def run(self):
+        try:
+            self._attachment["data"] = _b64_file(self._path)
+        except Exception as e:
+            # 任何失败都必须发出信号，否则 _attach_encoding 计数不会归零，发送按钮一直禁用
+            if not isinstance(e, OSError):
+                log.exception("Failed to encode attachment %s", self._path)
+            self._failed_signal.emit(self._path, str(e) or type(e).__name__)
+            return
+        self._done_signal.emit(self._attachment, self._cache_key, self._seq)
+
+
+class _SystemPromptSaveTask(QRunnable):
+    """在线程池中保存项目 system prompt，失败时经信号通知 UI。"""
+
+    def __init__(self, project_mgr: ProjectManager, project_id: str, prompt: str, failed_signal):
+        super().__init__()
+        self._project_mgr = project_mgr
+        self._project_id = project_id
+        self._prompt = prompt
+        self._failed_signal = failed_signal
+
+    def run(self):
+        try:
+            self._project_mgr.update(self._project_id, system_prompt=self._prompt)
+        except Exception as e:
+            log.exception("Failed to save system prompt for project %s", self._project_id)
+            self._failed_signal.emit(str(e))
+
+
+class _WriteTask(QRunnable):
+    """在线程池中把文本写入文件，完成/失败经信号通知 UI。"""
+
+    def __init__(self, path: str, content: str, done_signal, failed_signal):
+        super().__init__()
+        self._path = path
+        self._content = content
+        self._done_signal = done_signal
+        self._failed_signal = failed_signal
+
+    def run(self):
+        try:
+            Path(self._path).write_text(self._content, encoding="utf-8")
+        except Exception as e:
+            log.error("Failed to save markdown file: %s", e)
+            self._failed_signal.emit(str(e))
+        else:
+            self._done_signal.emit(self._path)
+
+
+class _StatsTask(QRunnable):
+    """在线程池中查询统计面板数据（及未命中缓存时的 4 层预估），结果经信号交回 UI 线程。"""
+
+    def __init__(self, conv_mgr: ConversationManager, builder: ContextBuilder, job: dict, done_signal):
+        super().__init__()
+        self._conv_mgr = conv_mgr
+        self._builder = builder
+        self._job = job
+        self._done_signal = done_signal
+
+    def run(self):
+        job = self._job
+        try:
+            job["stats"] = self._conv_mgr.get_full_stats(job["conversation_id"])
+        except Exception:
+            log.exception("Failed to load conversation stats")
+            return
+        if job["estimate"] is None:
+            try:
+                job["estimate"] = self._builder.estimate_request(
+                    project_id=job["project_id"],
+                    conversation_id=job["conversation_id"],
+                    user_message="",
+                    system_prompt=job["system_prompt"],
+                    model_id=job["model_id"],
+                )
+            except Exception as e:
+                log.debug(f"Cache visualization update failed: {e}")
+        self._done_signal.emit(job)
+
+
+class _CompressionTask(QRunnable):
+    """在线程池中检查并执行历史压缩（Haiku 调用），进度与结果经信号通知 UI。"""
+
+    def __init__(self, conversation_id: str, project_name: str, status_signal, done_signal):
+        super().__init__()
+        self._conversation_id = conversation_id
+        self._project_name = project_name
+        self._status_signal = status_signal
+        self._done_signal = done_signal
+
+    def run(self):
+        compressor = ContextCompressor()
+        try:
+            # 检查是否需要压缩
+            if not compressor.should_compress(self._conversation_id):
+                return
+            # 显示压缩开始状态
+            self._status_signal.emit("正在整理历史记忆... (Haiku)", 3000)
+            log.info("Starting background compression for conversation %s", self._conversation_id[:8])
+            result = compressor.compress(self._conversation_id, self._project_name)
+        except Exception:
+            log.exception("Compression failed")
+            return
+        if result and result.success:
+            saved = result.tokens_saved
+            log.info("Compression complete: saved %d tokens", saved)
+            self._done_signal.emit(
+                f"历史记忆已更新，节省 {saved:,} tokens" if saved > 0 else "历史记忆已更新"
+            )
+        else:
+            log.warning("Compression failed: %s", result.error if result else "Unknown error")
+
+
+class _FinalRenderTask(QRunnable):
+    """在线程池中完整渲染流式回复与思考内容，结果经信号交回 UI 线程。
+
+    分块拼接的 HTML 只用于流式刷新；跨空行的结构（如松散列表）需要整段解析，
+    因此最终消息总是对全文重新渲染。
+    """
+
+    def __init__(self, job: dict, done_signal):
+        super().__init__()
+        self._job = job
+        self._done_signal = done_signal
+
+    def run(self):
+        job = self._job
+        thinking = job["thinking_text"]
+        try:
+            job["thinking_html"] = render_markdown(thinking) if thinking.strip() else ""
+            job["final_html"] = render_markdown(job["full_text"])
+        except Exception:
+            # 渲染失败也必须发出信号，否则 UI 会停留在流式状态
+            log.exception("Final render failed")
+            job["thinking_html"] = (
+                f"<pre>{html_mod.escape(thinking)}</pre>" if thinking.strip() else ""
+            )
+            job["final_html"] = f"<pre>{html_mod.escape(job['full_text'])}</pre>"
+        self._done_signal.emit(job)
+
+
+_SHUTDOWN_POOL_WAIT_MS = 2000  # 退出时每轮等待每个线程池的时长
+_SHUTDOWN_WAIT_ROUNDS = 5
+
+
+class _DrainPoolsTask(QRunnable):
+    """退出第一步：等待所有线程池中的任务结束，经信号告知 UI 线程是否全部结束。
+
+    必须在独立的线程池中运行：在被等待的池里 waitForDone 会等到自己。
+    """
+
+    def __init__(self, pools: tuple[QThreadPool, ...], done_signal):
+        super().__init__()
+        self._pools = pools
+        self._done_signal = done_signal
+
+    def run(self):
+        for _ in range(_SHUTDOWN_WAIT_ROUNDS):
+            if all(pool.waitForDone(_SHUTDOWN_POOL_WAIT_MS) for pool in self._pools):
+                self._done_signal.emit(True)
+                return
+            log.warning("Background tasks still running at shutdown, waiting")
+        self._done_signal.emit(False)
+
+
+class _ShutdownTask(QRunnable):
+    """退出第二步：写入延迟队列并关闭数据库。
+
+    在 UI 线程处理完已排队的流式结束信号（回复入库）之后才启动；
+    仍有任务在运行时只写入队列、不关闭连接，避免在其使用中关闭数据库。
+    """
+
+    def __init__(self, close_db: bool, done_signal):
+        super().__init__()
+        self._close_db = close_db
+        self._done_signal = done_signal
+
+    def run(self):
+        try:
+            db.flush()
+            if self._close_db:
+                db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                db.close()
+            else:
+                log.error("Background tasks still running at exit; database left open")
+        except Exception:
+            log.exception("Shutdown cleanup failed")
+        self._done_signal.emit()
 
 
 class MainWindow(QMainWindow):
     """Three-panel main application window."""
 
+    _SEND_BTN_QSS = "QPushButton { background: #D97706; color: white; border-radius: 6px; font-weight: bold; }"
+    _STOP_BTN_QSS = "QPushButton { background: #E74C3C; color: white; border-radius: 6px; font-weight: bold; }"
+
+    projects_loaded = Signal(list)
+    doc_uploaded = Signal(dict)
+    doc_upload_failed = Signal(str, str)
+    attachment_encoded = Signal(dict, object, int)
+    pools_drained = Signal(bool)
+    shutdown_done = Signal()
+    system_prompt_save_failed = Signal(str)
+    file_saved = Signal(str)
+    stats_loaded = Signal(dict)
+    compression_status = Signal(str, int)
+    compression_finished = Signal(str)
+    file_save_failed = Signal(str)
+    final_rendered = Signal(dict)
+    attachment_failed = Signal(str, str)
+    client_ready = Signal(str)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle(f"{APP_NAME} v{APP_VERSION}")
@@ -238,20 +876,98 @@ class MainWindow(QMainWindow):
         self.current_project: Project | None = None
         self.current_conv: Conversation | None = None
         self.worker: APIWorker | None = None
-        self.compression_worker: CompressionWorker | None = None  # PRD v3: 压缩工作线程
+        # API 流式请求专用的常驻单线程池（线程不过期，跨消息复用）
+        self._api_pool = QThreadPool(self)
+        self._api_pool.setMaxThreadCount(1)
+        self._api_pool.setExpiryTimeout(-1)
         self.is_streaming = False
+        self._shutting_down = False
+        self._shutdown_complete = False
         self._accumulated_thinking = ""
-        self._inject_chat_history_connected = False
-        self._pending_history_messages = None
+        # 每次流式回复的递增 id；页面端据此丢弃与 runJavaScript 调用乱序到达的过期更新
+        self._stream_id = 0
+        # 聊天页面只 setHtml 一次；加载完成前要显示的历史先暂存
+        self._page_loaded = False
+        self._pending_history_messages: list | None = None
+        # 4 层缓存仪表盘的预估结果 LRU；_estimate_gen 在文档/消息/摘要变化时递增
+        self._estimate_cache: OrderedDict[tuple, dict] = OrderedDict()
+        self._estimate_gen = 0
+        self._last_viz_key: tuple | None = None  # 仪表盘当前显示的预估对应的键
+        self._doc_tokens_by_project: dict[str, int] = {}  # 项目文档 token 总数，_refresh_documents 时更新
+        self._doc_ids_by_project: dict[str, tuple] = {}  # 项目文档 id 列表，用于判断文档集合是否变化
+        self._system_tokens_by_project: dict[str, int] = {}  # system prompt 估算 token 数，保存时更新
+        # 列表 id -> 行号，填充列表时重建，替代逐行比对 UserRole
+        self._project_row_by_id: dict[str, int] = {}
+        self._conv_row_by_id: dict[str, int] = {}  # 对话 id -> 对话列表行号
+        self._history_queue: list[dict] = []  # 尚未送入页面的历史消息（分批注入）
+        # 当前对话的搜索索引 (uid, role, 小写内容)，加载历史时构建、新消息时追加
+        self._lc_index: list[tuple[str, str, str]] = []  # 内容预先转小写，搜索时不再逐条 lower()
+        # 增量流式渲染：已完成的块只渲染一次（其 HTML 已追加到页面）
+        self._stream_render = StreamRenderCache()
+        # 历史消息 meta 文本缓存 (msg.id -> meta)，消息入库后不再变化
+        self._meta_cache: dict[str, str] = {}
+        # 消息 HTML 缓存 (msg.id -> html)，每条入库消息只解析一次 markdown
+        self._md_cache: OrderedDict[str, str] = OrderedDict()
+        # 流式刷新节流：~30 Hz 合并多个 delta 为一次渲染 + 页面更新
+        self._stream_parts: list[str] = []  # 本次回复已收到的增量文本
+        self._stream_dirty = False
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(33)
+        self._flush_timer.timeout.connect(self._flush_stream)
+        # 统计信息刷新防抖：250 ms 内多次请求只查询/渲染一次（尾沿触发）；
+        # 流式输出期间只记下 _stats_dirty，结束后再刷新
+        self._stats_dirty = False
+        self._stats_timer = QTimer(self)
+        self._stats_timer.setSingleShot(True)
+        self._stats_timer.setInterval(250)
+        self._stats_timer.timeout.connect(self._do_update_stats)
+        # 统计查询串行执行：同一时刻只有一个任务使用 _stats_builder
+        self._stats_pool = QThreadPool(self)
+        self._stats_pool.setMaxThreadCount(1)
+        self._stats_builder = ContextBuilder()
+        # 多文件上传完成时合并刷新文档列表
+        self._doc_refresh_timer = QTimer(self)
+        self._doc_refresh_timer.setSingleShot(True)
+        self._doc_refresh_timer.setInterval(50)
+        self._doc_refresh_timer.timeout.connect(self._refresh_documents)
+        # 输入时的 thinking 预算建议：停止输入 150 ms 后再计算
+        self._recommend_timer = QTimer(self)
+        self._recommend_timer.setSingleShot(True)
+        self._recommend_timer.setInterval(150)
+        self._recommend_timer.timeout.connect(self._recommend_thinking_budget)
 
         self._build_ui()
         self._setup_shortcuts()
         self._setup_context_menu()
-        self._init_client()
-        self._refresh_projects()
+
+        # 磁盘/数据库相关的初始化推迟到首帧绘制之后
+        self.projects_loaded.connect(self._populate_projects_ui)
+        self.doc_uploaded.connect(self._on_doc_uploaded)
+        self.doc_upload_failed.connect(self._on_doc_upload_failed)
+        self.attachment_encoded.connect(self._on_attachment_encoded)
+        self.pools_drained.connect(self._on_pools_drained)
+        self.shutdown_done.connect(self._on_shutdown_done)
+        self.system_prompt_save_failed.connect(self._on_system_prompt_save_failed)
+        self.stats_loaded.connect(self._on_stats_loaded)
+        self.compression_status.connect(self.statusBar().showMessage)
+        self.compression_finished.connect(self._on_compression_finished)
+        self.file_saved.connect(lambda path: self.statusBar().showMessage(f"已保存: {path}", 3000))
+        self.file_save_failed.connect(lambda err: self.statusBar().showMessage(f"保存失败: {err}", 3000))
+        self.final_rendered.connect(self._on_final_rendered)
+        self.attachment_failed.connect(self._on_attachment_failed)
+        self.client_ready.connect(self.statusBar().showMessage)
+        QTimer.singleShot(0, self._async_bootstrap)
 
         log.info("Main window initialized")
 
+    def _async_bootstrap(self):
+        """Runs after the first paint: fetch projects and load the API key off the UI thread."""
+        pool = QThreadPool.globalInstance()
+        pool.start(_ProjectLoadTask(self.project_mgr, self.projects_loaded))
+        self._init_client()
+        pool.start(_MarkdownPrewarmTask())
+
     def _build_ui(self):
         central = QWidget()
         self.setCentralWidget(central)
@@ -260,32 +976,10 @@ class MainWindow(QMainWindow):
         main_layout.setSpacing(0)
 
         # 获取当前主题颜色
-        top_bar_bg = "#252525"
-        top_bar_border = "#3A3A3A"
-        label_color = "#AAAAAA"
-        try:
-            import json
-            from pathlib import Path
-            theme_file = Path.home() / "ClaudeStation" / "theme_config.json"
-            if theme_file.exists():
-                with open(theme_file, "r", encoding="utf-8") as f:
-                    theme_data = json.load(f)
-                    if theme_data.get("mode") == "light":
-                        top_bar_bg = "#F5F5F0"
-                        top_bar_border = "#CCCCCC"
-                        label_color = "#1A1A1A"
-        except:
-            pass
-        
+        colors = _theme_colors()
+
         top_bar = QFrame()
-        top_bar.setStyleSheet(f"""
-            QFrame {{ 
-                background: {top_bar_bg}; 
-                border-bottom: 1px solid {top_bar_border}; 
-                padding: 4px; 
-            }}
-            QLabel {{ color: {label_color}; font-size: 13px; }}
-        """)
+        top_bar.setStyleSheet(colors["top_bar_qss"])
         top_layout = QHBoxLayout(top_bar)
         top_layout.setContentsMargins(12, 6, 12, 6)
 
@@ -293,12 +987,9 @@ class MainWindow(QMainWindow):
         self.model_combo = QComboBox()
         self.model_combo.setMinimumWidth(280)
         
-        for mid, minfo in MODELS.items():
-            display_text = f"{minfo.display_name} ${minfo.input_price}/${minfo.output_price}"
+        for display_text, mid in _MODEL_ITEMS:
             self.model_combo.addItem(display_text, mid)
-        
-        default_idx = self.model_combo.findData(DEFAULT_MODEL)
-        self.model_combo.setCurrentIndex(default_idx if default_idx >= 0 else 0)
+        self.model_combo.setCurrentIndex(_MODEL_INDEX.get(DEFAULT_MODEL, 0))
         
         self.model_combo.currentIndexChanged.connect(self._on_model_changed)
         top_layout.addWidget(self.model_combo)
@@ -320,7 +1011,7 @@ class MainWindow(QMainWindow):
         self.thinking_budget.setCurrentIndex(1)
         
         self.thinking_recommend_label = QLabel("")
-        self.thinking_recommend_label.setStyleSheet("color: #888; font-size: 11px;")
+        self.thinking_recommend_label.setStyleSheet(_HINT_LABEL_QSS)
         self.thinking_recommend_label.setVisible(False)
         
         thinking_budget_layout.addWidget(QLabel("Budget:"))
@@ -343,31 +1034,14 @@ class MainWindow(QMainWindow):
 
         # PRD v3 §8.6: 搜索栏
         search_bar = QFrame()
-        search_bar.setStyleSheet("""
-            QFrame { 
-                background: #2A2A2A; 
-                border-bottom: 1px solid #3A3A3A; 
-                padding: 4px;
-            }
-        """)
+        search_bar.setStyleSheet(_SEARCH_BAR_QSS)
         search_layout = QHBoxLayout(search_bar)
         search_layout.setContentsMargins(12, 4, 12, 4)
         
         search_layout.addWidget(QLabel("🔍"))
         self.search_box = QLineEdit()
         self.search_box.setPlaceholderText("搜索当前对话... (Ctrl+F)")
-        self.search_box.setStyleSheet("""
-            QLineEdit {
-                background: #3A3A3A;
-                color: #E5E5E5;
-                border: 1px solid #555;
-                border-radius: 4px;
-                padding: 4px 8px;
-            }
-            QLineEdit:focus {
-                border-color: #D97706;
-            }
-        """)
+        self.search_box.setStyleSheet(_SEARCH_BOX_QSS)
         self.search_box.setMinimumWidth(250)
         self.search_box.returnPressed.connect(self._search_messages)
         search_layout.addWidget(self.search_box)
@@ -375,25 +1049,19 @@ class MainWindow(QMainWindow):
         self.btn_search_prev = QPushButton("↑")
         self.btn_search_prev.setFixedSize(28, 28)
         self.btn_search_prev.setToolTip("上一条匹配")
-        self.btn_search_prev.setStyleSheet("""
-            QPushButton { background: #3A3A3A; color: #AAA; border: 1px solid #555; border-radius: 4px; }
-            QPushButton:hover { background: #454545; color: #FFF; }
-        """)
+        self.btn_search_prev.setStyleSheet(_SEARCH_BTN_QSS)
         self.btn_search_prev.clicked.connect(self._search_prev)
         search_layout.addWidget(self.btn_search_prev)
         
         self.btn_search_next = QPushButton("↓")
         self.btn_search_next.setFixedSize(28, 28)
         self.btn_search_next.setToolTip("下一条匹配")
-        self.btn_search_next.setStyleSheet("""
-            QPushButton { background: #3A3A3A; color: #AAA; border: 1px solid #555; border-radius: 4px; }
-            QPushButton:hover { background: #454545; color: #FFF; }
-        """)
+        self.btn_search_next.setStyleSheet(_SEARCH_BTN_QSS)
         self.btn_search_next.clicked.connect(self._search_next)
         search_layout.addWidget(self.btn_search_next)
         
         self.search_result_label = QLabel("")
-        self.search_result_label.setStyleSheet("color: #888; font-size: 11px;")
+        self.search_result_label.setStyleSheet(_HINT_LABEL_QSS)
         search_layout.addWidget(self.search_result_label)
         
         search_layout.addStretch()
@@ -401,10 +1069,7 @@ class MainWindow(QMainWindow):
         # 关闭搜索栏按钮
         btn_close_search = QPushButton("✕")
         btn_close_search.setFixedSize(24, 24)
-        btn_close_search.setStyleSheet("""
-            QPushButton { background: transparent; color: #888; border: none; font-size: 14px; }
-            QPushButton:hover { color: #E74C3C; }
-        """)
+        btn_close_search.setStyleSheet(_CLOSE_SEARCH_BTN_QSS)
         btn_close_search.clicked.connect(self._close_search)
         search_layout.addWidget(btn_close_search)
         
@@ -423,11 +1088,7 @@ class MainWindow(QMainWindow):
         proj_header.addWidget(QLabel(" **Projects**"))
         btn_new_proj = QPushButton("＋ 新项目")
         btn_new_proj.setFixedHeight(28)
-        btn_new_proj.setStyleSheet(
-            "QPushButton { font-size: 12px; font-weight: bold; color: #E5E5E5; "
-            "background: #3A3A3A; border: 1px solid #555; border-radius: 4px; min-width: 72px; }"
-            "QPushButton:hover { background: #454545; }"
-        )
+        btn_new_proj.setStyleSheet(_NEW_BTN_QSS)
         btn_new_proj.setToolTip("New Project (Ctrl+Shift+N)")
         btn_new_proj.clicked.connect(self._new_project)
         proj_header.addWidget(btn_new_proj)
@@ -448,11 +1109,7 @@ class MainWindow(QMainWindow):
         conv_header.addWidget(QLabel(" **Conversations**"))
         btn_new_conv = QPushButton("＋ 新对话")
         btn_new_conv.setFixedHeight(28)
-        btn_new_conv.setStyleSheet(
-            "QPushButton { font-size: 12px; font-weight: bold; color: #E5E5E5; "
-            "background: #3A3A3A; border: 1px solid #555; border-radius: 4px; min-width: 72px; }"
-            "QPushButton:hover { background: #454545; }"
-        )
+        btn_new_conv.setStyleSheet(_NEW_BTN_QSS)
         btn_new_conv.setToolTip("New Conversation (Ctrl+N)")
         btn_new_conv.clicked.connect(self._new_conversation)
         conv_header.addWidget(btn_new_conv)
@@ -475,34 +1132,14 @@ class MainWindow(QMainWindow):
         self.chat_view = QWebEngineView()
         center_layout.addWidget(self.chat_view, 1)
 
-        # 获取当前主题颜色
-        input_bg = "#252525"
-        input_border = "#3A3A3A"
-        try:
-            import json
-            from pathlib import Path
-            theme_file = Path.home() / "ClaudeStation" / "theme_config.json"
-            if theme_file.exists():
-                with open(theme_file, "r", encoding="utf-8") as f:
-                    theme_data = json.load(f)
-                    if theme_data.get("mode") == "light":
-                        input_bg = "#FFFFFF"
-                        input_border = "#DDDDDD"
-        except:
-            pass
-        
         input_frame = QFrame()
-        input_frame.setStyleSheet(f"""
-            QFrame {{ 
-                background: {input_bg}; 
-                border-top: 1px solid {input_border}; 
-            }}
-        """)
+        input_frame.setStyleSheet(colors["input_frame_qss"])
         input_layout = QVBoxLayout(input_frame)
         input_layout.setContentsMargins(12, 8, 12, 8)
 
         attach_row = QHBoxLayout()
         self.attach_list_container = QWidget()
+        self.attach_list_container.setStyleSheet(_ATTACH_CHIPS_QSS)
         self.attach_list_layout = QHBoxLayout(self.attach_list_container)
         self.attach_list_layout.setContentsMargins(0, 0, 0, 0)
         self.attach_list_layout.setSpacing(6)
@@ -516,7 +1153,7 @@ class MainWindow(QMainWindow):
         )
         self.input_box.setMaximumHeight(120)
         self.input_box.setAcceptRichText(False)
-        self.input_box.textChanged.connect(self._recommend_thinking_budget)
+        self.input_box.textChanged.connect(self._recommend_timer.start)
         input_row.addWidget(self.input_box, 1)
 
         btn_col = QVBoxLayout()
@@ -528,8 +1165,10 @@ class MainWindow(QMainWindow):
 
         self.btn_send = QPushButton("Send")
         self.btn_send.setFixedSize(60, 36)
-        self.btn_send.setStyleSheet("QPushButton { background: #D97706; color: white; border-radius: 6px; font-weight: bold; }")
-        self.btn_send.clicked.connect(self._send_message)
+        self.btn_send.setStyleSheet(self._SEND_BTN_QSS)
+        self._send_btn_state = "send"
+        self._send_btn_handler = None
+        self._set_send_button_handler(self._send_message)
         btn_col.addWidget(self.btn_send)
         input_row.addLayout(btn_col)
 
@@ -537,8 +1176,13 @@ class MainWindow(QMainWindow):
         center_layout.addWidget(input_frame)
         splitter.addWidget(center_panel)
 
-        self.chat_view.setPage(ChatWebPage(self))
+        self._chat_page = ChatWebPage(self)
+        self.chat_view.setPage(self._chat_page)
+        # 页面对象固定不变，缓存绑定方法供热路径使用
+        self._run_js = self._chat_page.runJavaScript
+        self._chat_page.loadFinished.connect(self._on_chat_page_loaded)
         # #region agent log
+        # 唯一一次 setHtml；之后切换对话/清空都通过 replaceHistoryChunk 修改 DOM
         self.chat_view.setHtml(get_chat_html_template(dark_mode=True))
         _dlog("main_window.py:254", "setHtml called", {"caller": "init"}, "H1")
         # #endregion
@@ -575,7 +1219,7 @@ class MainWindow(QMainWindow):
         right_layout.addWidget(self.doc_list)
 
         self.doc_tokens_label = QLabel("Documents: 0 tokens")
-        self.doc_tokens_label.setStyleSheet("color: #888; font-size: 11px;")
+        self.doc_tokens_label.setStyleSheet(_HINT_LABEL_QSS)
         right_layout.addWidget(self.doc_tokens_label)
 
         sep3 = QFrame()
@@ -595,25 +1239,13 @@ class MainWindow(QMainWindow):
         
         right_layout.addWidget(QLabel(" **4-Layer Cache**"))
         
-        # Layer 1: System + Docs
-        self.layer1_label = QLabel("L1: System+Docs -")
-        self.layer1_label.setStyleSheet("color: #4CAF50; font-size: 11px;")
-        right_layout.addWidget(self.layer1_label)
-        
-        # Layer 2: Rolling Summary
-        self.layer2_label = QLabel("L2: Summary -")
-        self.layer2_label.setStyleSheet("color: #2196F3; font-size: 11px;")
-        right_layout.addWidget(self.layer2_label)
-        
-        # Layer 3: Recent Messages
-        self.layer3_label = QLabel("L3: Recent -")
-        self.layer3_label.setStyleSheet("color: #FF9800; font-size: 11px;")
-        right_layout.addWidget(self.layer3_label)
-        
-        # Layer 4: Current Message
-        self.layer4_label = QLabel("L4: Current -")
-        self.layer4_label.setStyleSheet("color: #9C27B0; font-size: 11px;")
-        right_layout.addWidget(self.layer4_label)
+        # L1 System+Docs / L2 Rolling Summary / L3 Recent Messages / L4 Current Message
+        self.layer_labels: list[QLabel] = []
+        for prefix, color in _LAYER_SPECS:
+            lbl = QLabel(f"{prefix} -")
+            lbl.setStyleSheet(_LAYER_QSS % color)
+            right_layout.addWidget(lbl)
+            self.layer_labels.append(lbl)
         
         # Total tokens
         self.total_tokens_label = QLabel("Total: 0 / 200K")
@@ -632,17 +1264,24 @@ class MainWindow(QMainWindow):
 
         self.statusBar().showMessage("Ready")
         self.pending_attachments: list[dict] = []
-        self._pending_history_messages: list | None = None
+        self._chip_widgets: list[QFrame] = []  # 与 pending_attachments 一一对应的 chip
+        # 已编码附件 LRU 缓存：(path, mtime_ns, size) -> attachment，重复添加同一文件不再读盘编码
+        self._attach_cache: OrderedDict[tuple, dict] = OrderedDict()
+        # 线程池中尚未完成的附件编码数；大于 0 时禁止发送，避免附件落到下一条消息
+        self._attach_encoding = 0
+        # 附件按用户选择的顺序排列（并发编码的完成顺序不定）：每个文件在选择时分配序号，
+        # _attach_order 与 pending_attachments 一一对应、保持升序
+        self._attach_seq = 0
+        self._attach_order: list[int] = []
 
     def _setup_shortcuts(self):
-        QShortcut(QKeySequence("Ctrl+Return"), self).activated.connect(self._send_message)
-        QShortcut(QKeySequence("Ctrl+N"), self).activated.connect(self._new_conversation)
-        QShortcut(QKeySequence("Ctrl+Shift+N"), self).activated.connect(self._new_project)
-        QShortcut(QKeySequence("Ctrl+,"), self).activated.connect(self._open_settings)
-        QShortcut(QKeySequence("Ctrl+L"), self).activated.connect(self.input_box.setFocus)
-        QShortcut(QKeySequence("Escape"), self).activated.connect(self._cancel_streaming)
-        # PRD v3 §8.6: 对话内搜索
-        QShortcut(QKeySequence("Ctrl+F"), self).activated.connect(self._toggle_search)
+        for key, seq, slot in _shortcuts():
+            shortcut = QShortcut(seq, self)
+            shortcut.activated.connect(slot(self))
+            if key == _ESCAPE_KEY:
+                # Esc 只在流式输出期间用于取消，其余时间留给菜单/对话框关闭
+                shortcut.setEnabled(False)
+                self._cancel_shortcut = shortcut
     
     def _setup_context_menu(self):
         """Disable default context menu."""
@@ -666,7 +1305,7 @@ class MainWindow(QMainWindow):
         self._search_matches = []
         self._current_match_index = 0
         # 清除搜索高亮
-        self.chat_view.page().runJavaScript("clearSearch()")
+        self._run_js("clearSearch()")
 
     def _search_messages(self):
         """Search messages in current conversation."""
@@ -675,30 +1314,23 @@ class MainWindow(QMainWindow):
         if not query:
             self.search_result_label.setText("")
             self._search_matches = []
-            self.chat_view.page().runJavaScript("clearSearch()")
+            self._run_js("clearSearch()")
             return
         
         if not self.current_conv:
             self.search_result_label.setText("请先选择一个对话")
             return
         
-        # 获取当前对话的所有消息
-        messages = self.conv_mgr.get_messages(self.current_conv.id)
-        
-        # 搜索匹配的消息
-        self._search_matches = []
-        for i, msg in enumerate(messages):
-            if query in msg.content.lower():
-                self._search_matches.append({
-                    'index': i,
-                    'uid': msg.id,
-                    'role': msg.role,
-                    'preview': msg.content[:100].replace('\n', ' ')
-                })
+        # 在预先小写化的索引上匹配，不再每次查询都读库并 lower()
+        self._search_matches = [
+            {'index': i, 'uid': uid, 'role': role}
+            for i, (uid, role, content_lower) in enumerate(self._lc_index)
+            if query in content_lower
+        ]
         
         if not self._search_matches:
             self.search_result_label.setText(f"未找到匹配: {query}")
-            self.chat_view.page().runJavaScript("clearSearch()")
+            self._run_js("clearSearch()")
             return
         
         # 显示结果数量
@@ -712,10 +1344,8 @@ class MainWindow(QMainWindow):
         """Highlight search matches in the chat view."""
         # 将所有匹配的消息UID传给JS
         uids = [m['uid'] for m in self._search_matches]
-        escaped_query = query.replace("'", "\\'")
-        escaped_uids = json.dumps(uids)
-        js_code = f"highlightSearch('{escaped_query}', {escaped_uids}, {self._current_match_index})"
-        self.chat_view.page().runJavaScript(js_code)
+        js_code = f"highlightSearch({_js_str(query)}, {_jdumps(uids)}, {self._current_match_index})"
+        self._run_js(js_code)
 
     def _search_next(self):
         """Go to next search match."""
@@ -725,10 +1355,8 @@ class MainWindow(QMainWindow):
         self._current_match_index = (self._current_match_index + 1) % len(self._search_matches)
         self.search_result_label.setText(f"匹配 {self._current_match_index + 1}/{len(self._search_matches)}")
         
-        # 更新高亮
-        query = self.search_box.text().strip().lower()
-        if query:
-            self._highlight_search_results(query)
+        # 匹配列表已在页面中，只传当前下标
+        self._run_js(f"setSearchIndex({self._current_match_index})")
 
     def _search_prev(self):
         """Go to previous search match."""
@@ -738,46 +1366,37 @@ class MainWindow(QMainWindow):
         self._current_match_index = (self._current_match_index - 1) % len(self._search_matches)
         self.search_result_label.setText(f"匹配 {self._current_match_index + 1}/{len(self._search_matches)}")
         
-        # 更新高亮
-        query = self.search_box.text().strip().lower()
-        if query:
-            self._highlight_search_results(query)
+        # 匹配列表已在页面中，只传当前下标
+        self._run_js(f"setSearchIndex({self._current_match_index})")
 
     def _init_client(self):
-        default = self.key_manager.get_default_key()
-        if default:
-            _, key = default
-            self.client.configure(key)
-            self.statusBar().showMessage("API key loaded")
-            log.info("Client initialized with default API key")
-        else:
-            self.statusBar().showMessage("⚠ No API key configured - open Settings")
-            log.warning("No API key found")
+        # 结果经 client_ready 显示在状态栏；导入失败只影响发送，不影响其余启动流程
+        QThreadPool.globalInstance().start(
+            _ClientInitTask(self.key_manager, self.client, self.client_ready))
 
     def _on_model_changed(self, index):
         """Handle model switch with cache cost warning."""
         if not self.current_project:
             return
         
-        new_model = self.model_combo.currentData()
-        new_model_info = MODELS.get(new_model)
-        if not new_model_info:
+        if not 0 <= index < len(_MODEL_ITEMS):
             return
-        
-        docs = self.doc_processor.get_project_documents(self.current_project.id)
-        doc_tokens = sum(d.get('token_count', 0) for d in docs)
-        system_tokens = len(self.current_project.system_prompt) // 4
+        new_model = _MODEL_ITEMS[index][1]
+        new_model_info = MODELS[new_model]
+        
+        doc_tokens = self._doc_tokens_by_project.get(self.current_project.id)
+        if doc_tokens is None:
+            doc_tokens = self.doc_processor.get_total_tokens(self.current_project.id)
+        system_tokens = self._system_tokens_by_project.get(self.current_project.id)
+        if system_tokens is None:
+            system_tokens = len(self.current_project.system_prompt) // 4
+            self._system_tokens_by_project[self.current_project.id] = system_tokens
         total_cached = doc_tokens + system_tokens
         
         if total_cached == 0:
             total_cached = 500
         
-        recent = db.execute("""
-            SELECT cache_read_tokens, cache_creation_tokens 
-            FROM api_call_log 
-            WHERE project_id = ? AND model_id = ?
-            ORDER BY created_at DESC LIMIT 5
-        """, (self.current_project.id, new_model))
+        recent = db.execute(_RECENT_CACHE_SQL, (self.current_project.id, new_model))
         
         hit_count = sum(1 for r in recent if r['cache_read_tokens'] > 0)
         
@@ -813,21 +1432,10 @@ class MainWindow(QMainWindow):
         if not self.thinking_check.isChecked():
             return
         
-        text = self.input_box.toPlainText()
-        length = len(text)
+        # characterCount 含末尾段落符，无需复制整段文本
+        length = self.input_box.document().characterCount() - 1
         
-        if length < 200:
-            recommended = 1024
-            reason = "短问题，快速推理即可"
-        elif length < 1000:
-            recommended = 2048
-            reason = "中等复杂度，标准分析"
-        elif length < 3000:
-            recommended = 4096
-            reason = "较长内容，建议深度思考"
-        else:
-            recommended = 8192
-            reason = "复杂长文本，需要充分推理"
+        recommended, reason = _THINKING_BUDGETS[bisect_right(_THINKING_THRESHOLDS, length)]
         
         current = self.thinking_budget.currentData()
         if abs(current - recommended) >= 2048:
@@ -836,31 +1444,45 @@ class MainWindow(QMainWindow):
         else:
             self.thinking_recommend_label.setVisible(False)
 
-    def _refresh_projects(self):
-        self.project_list.clear()
-        projects = self.project_mgr.list_all()
-        for p in projects:
-            item = QListWidgetItem(p.name)
-            item.setData(Qt.ItemDataRole.UserRole, p.id)
-            self.project_list.addItem(item)
+    @staticmethod
+    def _select_row(list_widget: QListWidget, row: int, handler) -> None:
+        """Set the current row with signals blocked, then run the selection handler once."""
+        previous = list_widget.currentItem()
+        with QSignalBlocker(list_widget):
+            list_widget.setCurrentRow(row)
+        current = list_widget.currentItem()
+        if current is not previous:
+            handler(current, previous)
+
+    def _refresh_projects(self, select_id: str | None = None):
+        self._populate_projects_ui(self.project_mgr.list_all(), select_id)
+
+    @Slot(list)
+    def _populate_projects_ui(self, projects: list, select_id: str | None = None):
+        with _bulk(self.project_list):
+            self.project_list.clear()
+            self.project_list.addItems([p.name for p in projects])
+            self._project_row_by_id = {}
+            for row, p in enumerate(projects):
+                self.project_list.item(row).setData(Qt.ItemDataRole.UserRole, p.id)
+                self._project_row_by_id[p.id] = row
 
         # 恢复最后选择的项目和对话
         state = _get_app_state()
         last_project_id = state.get("last_project_id")
         last_conversation_id = state.get("last_conversation_id")
         
-        # 尝试选中最后项目
-        if last_project_id:
-            for i in range(self.project_list.count()):
-                if self.project_list.item(i).data(Qt.ItemDataRole.UserRole) == last_project_id:
-                    self.project_list.setCurrentRow(i)
-                    break
-            else:
-                # 如果没找到，使用第一个项目
-                if projects:
-                    self.project_list.setCurrentRow(0)
+        # 尝试选中指定/最后项目；只触发一次 _on_project_selected
+        target_id = select_id or last_project_id
+        if target_id:
+            row = self._project_row_by_id.get(target_id, -1)
+            # 如果没找到，使用第一个项目
+            if row < 0 and projects:
+                row = 0
+            if row >= 0:
+                self._select_row(self.project_list, row, self._on_project_selected)
         elif projects and not self.current_project:
-            self.project_list.setCurrentRow(0)
+            self._select_row(self.project_list, 0, self._on_project_selected)
         
         # 如果有最后对话ID且当前项目匹配，加载该对话
         if last_conversation_id and self.current_project:
@@ -872,12 +1494,7 @@ class MainWindow(QMainWindow):
         if ok and name.strip():
             model_id = self.model_combo.currentData()
             project = self.project_mgr.create(name.strip(), model=model_id)
-            self._refresh_projects()
-            for i in range(self.project_list.count()):
-                item = self.project_list.item(i)
-                if item.data(Qt.ItemDataRole.UserRole) == project.id:
-                    self.project_list.setCurrentRow(i)
-                    break
+            self._refresh_projects(select_id=project.id)
             log.info("Created project: %s", name)
 
     def _on_project_selected(self, current, previous):
@@ -924,27 +1541,31 @@ class MainWindow(QMainWindow):
         if not self.current_project:
             return
         # 查找并选中指定对话
-        for i in range(self.conv_list.count()):
-            item = self.conv_list.item(i)
-            if item.data(Qt.ItemDataRole.UserRole) == conversation_id:
-                self.conv_list.setCurrentRow(i)
-                log.debug("Restored last conversation: %s", conversation_id)
-                return
+        row = self._conv_row_by_id.get(conversation_id, -1)
+        if row >= 0:
+            self._select_row(self.conv_list, row, self._on_conv_selected)
+            log.debug("Restored last conversation: %s", conversation_id)
+            return
         log.debug("Last conversation not found: %s", conversation_id)
 
-    def _refresh_conversations(self):
-        self.conv_list.clear()
-        if not self.current_project:
-            return
-        convs = self.conv_mgr.list_conversations(self.current_project.id)
-        for c in convs:
-            item = QListWidgetItem(c.title)
-            item.setData(Qt.ItemDataRole.UserRole, c.id)
-            self.conv_list.addItem(item)
+    def _refresh_conversations(self, select_id: str | None = None):
+        convs = []
+        with _bulk(self.conv_list):
+            self.conv_list.clear()
+            self._conv_row_by_id = {}
+            if self.current_project:
+                convs = self.conv_mgr.list_conversations(self.current_project.id)
+                self.conv_list.addItems([c.title for c in convs])
+                for row, c in enumerate(convs):
+                    self.conv_list.item(row).setData(Qt.ItemDataRole.UserRole, c.id)
+                    self._conv_row_by_id[c.id] = row
 
+        # 信号在填充期间被屏蔽，这里只触发一次 _on_conv_selected
         if convs:
-            self.conv_list.setCurrentRow(0)
-        else:
+            row = self._conv_row_by_id.get(select_id, 0) if select_id else 0
+            self._select_row(self.conv_list, row, self._on_conv_selected)
+        elif self.current_project:
+            self.current_conv = None
             self._clear_chat()
 
     def _new_conversation(self):
@@ -952,12 +1573,7 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Error", "Select a project first.")
             return
         conv = self.conv_mgr.create_conversation(self.current_project.id)
-        self._refresh_conversations()
-        for i in range(self.conv_list.count()):
-            item = self.conv_list.item(i)
-            if item.data(Qt.ItemDataRole.UserRole) == conv.id:
-                self.conv_list.setCurrentRow(i)
-                break
+        self._refresh_conversations(select_id=conv.id)
         self.input_box.setFocus()
 
     def _on_conv_selected(self, current, previous):
@@ -1004,38 +1620,50 @@ class MainWindow(QMainWindow):
         conv = self.conv_mgr.get_conversation(conv_id)
         if not conv:
             return
+        # 先选路径：用户取消时不再查询/拼接任何内容
+        path, _ = QFileDialog.getSaveFileName(self, "Export", f"{conv.title}.md", "Markdown (*.md)")
+        if not path:
+            return
         messages = self.conv_mgr.get_messages(conv_id)
         stats = self.conv_mgr.get_conversation_stats(conv_id)
-
-        md = f"# {conv.title}\n\n"
-        md += f"- Model: {conv.model_override or (self.current_project.default_model if self.current_project else 'N/A')}\n"
-        md += f"- Messages: {stats['msg_count']}\n"
-        md += f"- Total Cost: ${stats['total_cost']:.4f}\n\n---\n\n"
-
-        for msg in messages:
-            role = "**You**" if msg.role == "user" else "**Claude**"
-            md += f"## {role}\n\n{msg.content}\n\n"
-            if msg.cost_usd:
-                md += f"*({msg.input_tokens} in / {msg.output_tokens} out, ${msg.cost_usd:.4f})*\n\n"
-            md += "---\n\n"
-
-        path, _ = QFileDialog.getSaveFileName(self, "Export", f"{conv.title}.md", "Markdown (*.md)")
-        if path:
-            Path(path).write_text(md, encoding="utf-8")
-            self.statusBar().showMessage(f"Exported to {path}")
+        model = conv.model_override or (self.current_project.default_model if self.current_project else 'N/A')
+
+        # 逐段写入文件，不在内存中拼接整份 Markdown
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# {conv.title}\n\n")
+            f.write(f"- Model: {model}\n")
+            f.write(f"- Messages: {stats['msg_count']}\n")
+            f.write(f"- Total Cost: ${stats['total_cost']:.4f}\n\n---\n\n")
+
+            for msg in messages:
+                role = "**You**" if msg.role == "user" else "**Claude**"
+                f.write(f"## {role}\n\n{msg.content}\n\n")
+                if msg.cost_usd:
+                    f.write(f"*({msg.input_tokens} in / {msg.output_tokens} out, ${msg.cost_usd:.4f})*\n\n")
+                f.write("---\n\n")
+        self.statusBar().showMessage(f"Exported to {path}")
 
     def _refresh_documents(self):
-        self.doc_list.clear()
-        if not self.current_project:
-            return
-        docs = self.doc_processor.get_project_documents(self.current_project.id)
-        total_tokens = 0
-        for d in docs:
-            tc = d.get("token_count", 0)
-            total_tokens += tc
-            item = QListWidgetItem(f"{d['filename']} ({tc:,} tokens)")
-            item.setData(Qt.ItemDataRole.UserRole, d["id"])
-            self.doc_list.addItem(item)
+        with _bulk(self.doc_list):
+            self.doc_list.clear()
+            if not self.current_project:
+                return
+            docs, total_tokens = self.doc_processor.get_project_documents_with_total(
+                self.current_project.id
+            )
+            self.doc_list.addItems(
+                [f"{d['filename']} ({d['token_count']:,} tokens)" for d in docs]
+            )
+            for i, d in enumerate(docs):
+                self.doc_list.item(i).setData(Qt.ItemDataRole.UserRole, d["id"])
+            # 只有文档集合或 token 总数变化时才使预估失效；单纯切换项目/重复刷新可复用缓存
+            pid = self.current_project.id
+            doc_ids = tuple(d["id"] for d in docs)
+            if (self._doc_ids_by_project.get(pid) != doc_ids
+                    or self._doc_tokens_by_project.get(pid) != total_tokens):
+                self._doc_ids_by_project[pid] = doc_ids
+                self._doc_tokens_by_project[pid] = total_tokens
+                self._estimate_gen += 1
         self.doc_tokens_label.setText(f"Documents: {total_tokens:,} tokens total")
 
     def _upload_document(self):
@@ -1043,19 +1671,28 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Error", "Select a project first.")
             return
         paths, _ = QFileDialog.getOpenFileNames(
-            self, "Upload Documents", "",
-            "All Supported (*.pdf *.docx *.txt *.md *.csv *.py *.js *.ts *.json *.xlsx *.xml *.yaml *.yml *.html *.css *.java *.c *.cpp *.go *.rs *.rb *.sql);;All Files (*)",
+            self, "Upload Documents", "", _UPLOAD_FILTER,
         )
+        if not paths:
+            return
+        pool = QThreadPool.globalInstance()
         for path in paths:
-            try:
-                result = self.doc_processor.add_document(self.current_project.id, path)
-                self.statusBar().showMessage(
-                    f"Uploaded: {result['filename']} ({result['token_count']:,} tokens)"
-                )
-            except Exception as e:
-                log.exception("Upload failed: %s", path)
-                QMessageBox.warning(self, "Upload Error", f"Failed to process {Path(path).name}: {e}")
-        self._refresh_documents()
+            pool.start(_DocUploadTask(
+                self.doc_processor, self.current_project.id, path,
+                self.doc_uploaded, self.doc_upload_failed,
+            ))
+        self.statusBar().showMessage(f"Processing {len(paths)} document(s)...")
+
+    @Slot(dict)
+    def _on_doc_uploaded(self, result: dict):
+        self.statusBar().showMessage(
+            f"Uploaded: {result['filename']} ({result['token_count']:,} tokens)"
+        )
+        self._doc_refresh_timer.start()
+
+    @Slot(str, str)
+    def _on_doc_upload_failed(self, path: str, error: str):
+        QMessageBox.warning(self, "Upload Error", f"Failed to process {Path(path).name}: {error}")
 
     def _doc_context_menu(self, pos):
         item = self.doc_list.itemAt(pos)
@@ -1070,7 +1707,7 @@ class MainWindow(QMainWindow):
             self._refresh_documents()
 
     def _clear_chat(self):
-        self.chat_view.setHtml(get_chat_html_template(dark_mode=True))
+        self._replace_history([])
         self.stats_label.setText("No conversation selected")
 
     def _ensure_chat_ready(self):
@@ -1084,105 +1721,151 @@ class MainWindow(QMainWindow):
                 return !!document.getElementById('chat');
             })();
         """
-        self.chat_view.page().runJavaScript(js_check)
+        self._run_js(js_check)
 
     def _load_chat_history(self):
         """Load and display all messages in current conversation."""
-        # #region agent log
-        self.chat_view.setHtml(get_chat_html_template(dark_mode=True))
-        _dlog("main_window.py:689", "setHtml called", {"caller": "load_chat_history"}, "H1")
-        # #endregion
-        if not self.current_conv:
-            return
-
-        messages = self.conv_mgr.get_messages(self.current_conv.id)
-        if not messages:
+        messages = self.conv_mgr.get_messages(self.current_conv.id) if self.current_conv else []
+        self._lc_index = [(m.id, m.role, m.content.lower()) for m in messages]
+        self._replace_history(self._history_payload(messages))
+
+    def _index_message(self, msg: Message | None):
+        """Add a newly stored message to the search index."""
+        if msg:
+            self._lc_index.append((msg.id, msg.role, msg.content.lower()))
+            self._estimate_gen += 1
+
+    def _replace_history(self, payload: list[dict]):
+        """Swap the page's messages in place (no page reload); queued until the page has loaded."""
+        if not self._page_loaded:
+            self._pending_history_messages = payload
             return
-        self._pending_history_messages = messages
-        
-        # 安全处理信号连接
-        self._inject_chat_history_connected = True
-        self.chat_view.page().loadFinished.connect(self._inject_chat_history)
-
-    def _inject_chat_history(self, ok: bool):
-        """Run after chat page load: inject message history (fixes addMessage not defined)."""
-        if not self._pending_history_messages:
-            return
-        
-        # 断开信号连接，避免重复触发
-        if getattr(self, '_inject_chat_history_connected', False):
-            try:
-                self.chat_view.page().loadFinished.disconnect(self._inject_chat_history)
-            except (TypeError, RuntimeError):
-                pass
-            self._inject_chat_history_connected = False
-        
-        messages = self._pending_history_messages
-        self._pending_history_messages = None
         # #region agent log
-        _dlog("main_window.py:_inject_chat_history", "runJS addMessage loop after loadFinished", {"msg_count": len(messages), "runId": "post-fix"}, "H1")
+        _dlog("main_window.py:_replace_history", "runJS replaceHistoryChunk", {"msg_count": len(payload)}, "H1")
         # #endregion
+        # 第一批同步替换旧内容，其余分批在事件循环空闲时追加，保持界面响应
+        first, self._history_queue = payload[:_HISTORY_CHUNK], payload[_HISTORY_CHUNK:]
+        self._run_js(f"replaceHistoryChunk({_jdumps(first)}, true)")
+        if self._history_queue:
+            QTimer.singleShot(0, self._send_history_chunk)
+
+    def _send_history_chunk(self, drain: bool = False):
+        """Append the next queued history chunk (all of it when drain is set)."""
+        if not self._history_queue:
+            return
+        n = len(self._history_queue) if drain else _HISTORY_CHUNK
+        chunk, self._history_queue = self._history_queue[:n], self._history_queue[n:]
+        self._run_js(f"replaceHistoryChunk({_jdumps(chunk)}, false)")
+        if self._history_queue:
+            QTimer.singleShot(0, self._send_history_chunk)
+
+    @Slot(bool)
+    def _on_chat_page_loaded(self, ok: bool):
+        self._page_loaded = True
+        if self._pending_history_messages is not None:
+            payload, self._pending_history_messages = self._pending_history_messages, None
+            self._replace_history(payload)
+
+    def _history_payload(self, messages: list[Message]) -> list[dict]:
+        """Build the addMessagesBulk entries for stored messages."""
+        payload = []
         for msg in messages:
-            html = render_markdown(msg.content)
-            meta = ""
-            if msg.role == "assistant" and msg.cost_usd:
-                meta = f"{msg.input_tokens:,} in / {msg.output_tokens:,} out"
-                if msg.cache_read_tokens:
-                    meta += f" / {msg.cache_read_tokens:,} cached"
-                meta += f" | ${msg.cost_usd:.4f}"
-            escaped_html = escape_js_string(html)
-            escaped_meta = escape_js_string(meta)
-            uid = msg.id
-            js_code = f"addMessage('{msg.role}', '{escaped_html}', '{escaped_meta}', '{uid}')"
-            # #region agent log
-            _dlog("main_window.py:718", "runJS addMessage", {"in_load_history": True, "after_load": True, "js_preview": js_code[:80]}, "H1")
-            # #endregion
-            self.chat_view.page().runJavaScript(js_code)
+            meta = self._meta_cache.get(msg.id)
+            if meta is None:
+                meta = self._meta_cache[msg.id] = self._format_meta(msg)
+            payload.append({"role": msg.role, "html": self._message_html(msg.id, msg.content),
+                            "meta": meta, "uid": msg.id})
+        return payload
+
+    def _message_html(self, msg_id: str, content: str) -> str:
+        """Rendered HTML of a stored message, cached by message id (LRU)."""
+        html = self._md_cache.get(msg_id)
+        if html is None:
+            html = self._remember_message_html(msg_id, render_markdown(content))
+        else:
+            self._md_cache.move_to_end(msg_id)
+        return html
+
+    def _remember_message_html(self, msg_id: str, html: str) -> str:
+        self._md_cache[msg_id] = html
+        if len(self._md_cache) > _MD_CACHE_SIZE:
+            self._md_cache.popitem(last=False)
+        return html
+
+    @staticmethod
+    def _format_meta(msg: Message) -> str:
+        """Token/cost meta line shown under an assistant message."""
+        if msg.role != "assistant" or not msg.cost_usd:
+            return ""
+        meta = f"{msg.input_tokens:,} in / {msg.output_tokens:,} out"
+        if msg.cache_read_tokens:
+            meta += f" / {msg.cache_read_tokens:,} cached"
+        return meta + f" | ${msg.cost_usd:.4f}"
 
     def _update_stats(self):
+        """Schedule a stats refresh; restarting the timer coalesces bursts into one query."""
+        self._stats_timer.start()
+
+    def _do_update_stats(self):
+        if self._shutting_down:
+            return
+        if self.is_streaming:
+            self._stats_dirty = True
+            return
+        self._stats_dirty = False
         if not self.current_conv:
             self.stats_label.setText("No conversation selected")
+            for lbl, (prefix, _) in zip(self.layer_labels, _LAYER_SPECS):
+                lbl.setText(f"{prefix} -")
+            self.total_tokens_label.setText("Total: 0 / 200K")
+            self._last_viz_key = None
             return
         
-        stats = self.conv_mgr.get_conversation_stats(self.current_conv.id)
-        
-        cache_stats = db.execute("""
-            SELECT 
-                SUM(CASE WHEN cache_read_tokens > 0 THEN 1 ELSE 0 END) as hits,
-                COUNT(*) as total,
-                SUM(cache_read_tokens) as total_cache_read,
-                SUM(input_tokens) as total_input
-            FROM api_call_log 
-            WHERE conversation_id = ?
-            ORDER BY created_at DESC LIMIT 10
-        """, (self.current_conv.id,))
+        project_id = self.current_project.id if self.current_project else ""
+        system_prompt = self.current_project.system_prompt if self.current_project else ""
+        model_id = self.current_conv.model_override or "claude-sonnet-4-5-20250929"
+        # 文档/消息/摘要变化时 _estimate_gen 递增，键不变即可直接复用上次预估
+        key = (project_id, self.current_conv.id, model_id, system_prompt, self._estimate_gen)
+        est = self._estimate_cache.get(key)
+        if est is not None:
+            self._estimate_cache.move_to_end(key)
+        # 数据库查询与 token 预估放到线程池，完成后由 _on_stats_loaded 更新标签
+        self._stats_pool.start(_StatsTask(self.conv_mgr, self._stats_builder, {
+            "conversation_id": self.current_conv.id, "project_id": project_id,
+            "system_prompt": system_prompt, "model_id": model_id,
+            "key": key, "estimate": est,
+        }, self.stats_loaded))
+
+    @Slot(dict)
+    def _on_stats_loaded(self, job: dict):
+        # 查询期间切换了对话：丢弃旧结果
+        if not self.current_conv or self.current_conv.id != job["conversation_id"]:
+            return
+        stats = job["stats"]
         
         cache_text = ""
         compression_text = ""
         
         # 缓存统计
-        if cache_stats and cache_stats[0]['total'] > 0:
-            s = cache_stats[0]
-            hit_rate = (s['hits'] / s['total']) * 100 if s['total'] > 0 else 0
-            cache_savings = s['total_cache_read'] * 0.9 / 1_000_000
+        if stats['api_calls'] > 0:
+            hit_rate = (stats['cache_hits'] / stats['api_calls']) * 100
+            cache_savings = stats['api_cache_read'] * 0.9 / 1_000_000
             
             cache_text = (
                 f"\n---\n"
-                f"Cache: {s['hits']}/{s['total']} ({hit_rate:.0f}%)\n"
+                f"Cache: {stats['cache_hits']}/{stats['api_calls']} ({hit_rate:.0f}%)\n"
                 f"Saved: ~${cache_savings:.4f}"
             )
         
         # PRD v3: 压缩统计
-        if self.current_conv:
-            compression_stats = self.conv_mgr.get_compression_stats(self.current_conv.id)
-            if compression_stats['has_summary']:
-                compression_text = (
-                    f"\n---\n"
-                    f"摘要: {compression_stats['summary_tokens']:,} tok\n"
-                    f"未压缩: {compression_stats['uncompressed_turns']} 轮"
-                )
-                if compression_stats['should_compress']:
-                    compression_text += " ⚡"
+        if stats['has_summary']:
+            compression_text = (
+                f"\n---\n"
+                f"摘要: {stats['summary_tokens']:,} tok\n"
+                f"未压缩: {stats['uncompressed_turns']} 轮"
+            )
+            if stats['should_compress']:
+                compression_text += " ⚡"
         
         txt = (
             f"Messages: {stats['msg_count']}\n"
@@ -1195,57 +1878,48 @@ class MainWindow(QMainWindow):
         self.stats_label.setText(txt)
         
         # 更新 4 层缓存可视化
-        self._update_cache_visualization()
+        est = job["estimate"]
+        if est is None:
+            return
+        key = job["key"]
+        if key not in self._estimate_cache:
+            self._estimate_cache[key] = est
+            if len(self._estimate_cache) > _ESTIMATE_CACHE_SIZE:
+                self._estimate_cache.popitem(last=False)
+        # 仪表盘已显示同一键的预估：不再重设标签
+        if key == self._last_viz_key:
+            return
+        self._last_viz_key = key
+        self._update_cache_visualization(est)
     
-    def _update_cache_visualization(self):
+    def _update_cache_visualization(self, est: dict):
         """更新4层缓存可视化仪表盘"""
-        if not self.current_conv:
-            self.layer1_label.setText("L1: System+Docs -")
-            self.layer2_label.setText("L2: Summary -")
-            self.layer3_label.setText("L3: Recent -")
-            self.layer4_label.setText("L4: Current -")
-            self.total_tokens_label.setText("Total: 0 / 200K")
-            return
-        
-        # 从 context_builder 获取当前层的 token 统计
-        from core.context_builder import ContextBuilder
-        cb = ContextBuilder()
-        
-        try:
-            # 预估请求
-            est = cb.estimate_request(
-                project_id=self.current_project.id if self.current_project else "",
-                conversation_id=self.current_conv.id,
-                user_message="",
-                system_prompt=self.current_project.system_prompt if self.current_project else "",
-                model_id=self.current_conv.model_override or "claude-sonnet-4-5-20250929"
-            )
-            
-            # 更新各层显示
-            sys_tok = est.get("system_tokens", 0)
-            sum_tok = est.get("summary_tokens", 0)
-            hist_tok = est.get("history_tokens", 0)
-            user_tok = est.get("user_tokens", 0)
-            total = est.get("total_tokens", 0)
-            
-            self.layer1_label.setText(f"L1: System+Docs {sys_tok:,} tok")
-            self.layer2_label.setText(f"L2: Summary {sum_tok:,} tok")
-            self.layer3_label.setText(f"L3: Recent {hist_tok:,} tok")
-            self.layer4_label.setText(f"L4: Current {user_tok:,} tok")
-            self.total_tokens_label.setText(f"Total: {total:,} / 200K")
-            
-            # 根据缓存状态改变颜色
-            if sum_tok >= 1024:
-                self.layer2_label.setStyleSheet("color: #4CAF50; font-size: 11px;")  # 绿色 = 缓存
-            else:
-                self.layer2_label.setStyleSheet("color: #FF9800; font-size: 11px;")  # 橙色 = 未缓存
-                
-        except Exception as e:
-            log.debug(f"Cache visualization update failed: {e}")
+        # 更新各层显示
+        sys_tok = est.get("system_tokens", 0)
+        sum_tok = est.get("summary_tokens", 0)
+        hist_tok = est.get("history_tokens", 0)
+        user_tok = est.get("user_tokens", 0)
+        total = est.get("total_tokens", 0)
+        
+        for lbl, (prefix, _), tok in zip(
+            self.layer_labels, _LAYER_SPECS, (sys_tok, sum_tok, hist_tok, user_tok)
+        ):
+            lbl.setText(f"{prefix} {tok:,} tok")
+        self.total_tokens_label.setText(f"Total: {total:,} / 200K")
+        
+        # 根据缓存状态改变颜色；样式未变时不重新设置，避免重复解析 QSS
+        qss = _LAYER_CACHED_QSS if sum_tok >= 1024 else _LAYER_UNCACHED_QSS
+        summary_label = self.layer_labels[1]
+        if summary_label.styleSheet() != qss:
+            summary_label.setStyleSheet(qss)
 
     def _send_message(self):
         if self.is_streaming:
             return
+        if self._attach_encoding:
+            # 快捷键路径不经过按钮的禁用状态
+            self.statusBar().showMessage("Attachments are still loading...", 3000)
+            return
         text = self.input_box.toPlainText().strip()
         if not text:
             return
@@ -1261,8 +1935,7 @@ class MainWindow(QMainWindow):
             if not self.current_conv:
                 return
 
-        messages = self.conv_mgr.get_messages(self.current_conv.id)
-        is_first_message = len(messages) == 0
+        is_first_message = self.conv_mgr.message_count(self.current_conv.id) == 0
         
         if is_first_message:
             # 新对话第一条消息：确保聊天页面已准备好
@@ -1274,11 +1947,9 @@ class MainWindow(QMainWindow):
             # 注意：不要在这里调用 _refresh_conversations()，因为它会触发 _load_chat_history() 
             # 导致聊天视图被清空，消息就显示不出来了
             # 改为只更新列表中的标题，不重新加载聊天历史
-            for i in range(self.conv_list.count()):
-                item = self.conv_list.item(i)
-                if item.data(Qt.ItemDataRole.UserRole) == self.current_conv.id:
-                    item.setText(title)
-                    break
+            row = self._conv_row_by_id.get(self.current_conv.id)
+            if row is not None:
+                self.conv_list.item(row).setText(title)
 
         attachments = self.pending_attachments.copy()
         user_msg = self.conv_mgr.add_message(
@@ -1286,18 +1957,19 @@ class MainWindow(QMainWindow):
             attachments=[{"type": a["type"], "filename": a.get("filename", "")} for a in attachments],
         )
         user_msg_uid = user_msg.id if user_msg else ""
+        self._index_message(user_msg)
 
         text_for_api = self._expand_uid_refs_in_message(text)
 
         user_html = render_markdown(text)
-        escaped = user_html.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n")
-        # #region agent log
-        _dlog("main_window.py:792", "runJS addMessage (send)", {"in_load_history": False, "is_first_msg": is_first_message, "escaped_len": len(escaped)}, "H2")
-        # #endregion
-        
+        # 先送完尚未注入的历史，保证新消息排在最后
+        self._send_history_chunk(drain=True)
         # 确保 HTML 已加载后再添加消息 (修复新对话首条消息不显示问题)
         # 传递 uid 和 rawMarkdown 以支持复制功能
-        escaped_raw = text.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n")
+        add_args = f"'user', {_js_str(user_html)}, '', {_js_str(user_msg_uid)}, {_js_str(text)}"
+        # #region agent log
+        _dlog("main_window.py:792", "runJS addMessage (send)", {"in_load_history": False, "is_first_msg": is_first_message, "escaped_len": len(add_args)}, "H2")
+        # #endregion
         
         # 如果是第一条消息，等待页面加载完成后再添加
         if is_first_message:
@@ -1305,7 +1977,7 @@ class MainWindow(QMainWindow):
                 (function() {{
                     var checkAndAdd = function() {{
                         if (typeof addMessage === 'function' && document.getElementById('chat')) {{
-                            addMessage('user', '{escaped}', '', '{user_msg_uid}', '{escaped_raw}');
+                            addMessage({add_args});
                         }} else {{
                             setTimeout(checkAndAdd, 50);
                         }}
@@ -1317,18 +1989,18 @@ class MainWindow(QMainWindow):
             js_code = f"""
                 (function() {{
                     if (typeof addMessage === 'function' && document.getElementById('chat')) {{
-                        addMessage('user', '{escaped}', '', '{user_msg_uid}', '{escaped_raw}');
+                        addMessage({add_args});
                     }} else {{
                         setTimeout(function() {{
-                            addMessage('user', '{escaped}', '', '{user_msg_uid}', '{escaped_raw}');
+                            addMessage({add_args});
                         }}, 100);
                     }}
                 }})();
             """
-        self.chat_view.page().runJavaScript(js_code)
+        self._run_js(js_code)
 
         self.input_box.clear()
-        self.pending_attachments.clear()
+        self._clear_attachments()
 
         model_id = self.model_combo.currentData()
         try:
@@ -1346,8 +2018,7 @@ class MainWindow(QMainWindow):
             err_s = str(e)
             _dlog("main_window.py:808", "runJS addError (context build)", {"exception_has_quote": "'" in err_s, "err_preview": err_s[:60]}, "H3")
             # #endregion
-            escaped_err = escape_js_string(err_s)
-            self.chat_view.page().runJavaScript(f"addError('Context build error: {escaped_err}')")
+            self._run_js(f"addError({_js_str('Context build error: ' + err_s)})")
             return
 
         thinking_cfg = None
@@ -1356,14 +2027,20 @@ class MainWindow(QMainWindow):
             thinking_cfg = {"type": "enabled", "budget_tokens": budget}
 
         self.is_streaming = True
-        self.btn_send.setText("Stop")
-        self.btn_send.setStyleSheet("QPushButton { background: #E74C3C; color: white; border-radius: 6px; font-weight: bold; }")
-        self.btn_send.clicked.disconnect()
-        self.btn_send.clicked.connect(self._cancel_streaming)
+        if self._send_btn_state != "stop":
+            self.btn_send.setText("Stop")
+            self.btn_send.setStyleSheet(self._STOP_BTN_QSS)
+            self._send_btn_state = "stop"
+        self._set_send_button_handler(self._cancel_streaming)
+        self._cancel_shortcut.setEnabled(True)
         self.statusBar().showMessage(f"Streaming... (~{est_tokens:,} input tokens)")
         self._accumulated_thinking = ""
+        self._stream_render.reset()
+        self._stream_parts = []
+        self._stream_dirty = False
 
-        self.chat_view.page().runJavaScript("startStreaming()")
+        self._stream_id += 1
+        self._run_js(f"startStreaming({self._stream_id})")
 
         self.worker = APIWorker(
             self.client, api_messages, system_content,
@@ -1371,17 +2048,39 @@ class MainWindow(QMainWindow):
             project_id=self.current_project.id,
             conversation_id=self.current_conv.id,
         )
-        self.worker.text_delta.connect(self._on_text_delta)
-        self.worker.thinking_delta.connect(self._on_thinking_delta)
-        self.worker.finished.connect(self._on_stream_finished)
-        self.worker.error.connect(self._on_stream_error)
-        self.worker.start()
+        # 信号由池线程发出，显式排队投递到 UI 线程
+        queued = Qt.ConnectionType.QueuedConnection
+        self.worker.signals.text_delta.connect(self._on_text_delta, queued)
+        self.worker.signals.thinking_delta.connect(self._on_thinking_delta, queued)
+        self.worker.signals.finished.connect(self._on_stream_finished, queued)
+        self.worker.signals.error.connect(self._on_stream_error, queued)
+        self._api_pool.start(self.worker)
 
     @Slot(str)
-    def _on_text_delta(self, full_text: str):
-        html = render_markdown(full_text)
-        escaped = html.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n")
-        self.chat_view.page().runJavaScript(f"appendStreamText('{escaped}')")
+    def _on_text_delta(self, delta: str):
+        self._stream_parts.append(delta)
+        self._stream_dirty = True
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def _flush_stream(self):
+        """Render the text received since the last flush and push it to the page."""
+        if not self._stream_dirty:
+            return
+        self._stream_dirty = False
+        full_text = "".join(self._stream_parts)
+        self._stream_parts = [full_text]
+        # 只重新渲染尾部块；新完成的块只渲染、发送一次，
+        # 页面端追加到前缀节点，已发送的前缀不再重复转义/传输
+        segment_html, tail_html = self._stream_render.update(full_text)
+        bridge = self._chat_page.bridge
+        if bridge.ready:
+            bridge.streamUpdated.emit(self._stream_id, segment_html, tail_html)
+            return
+        self._run_js(
+            f"appendStreamTextIncremental({self._stream_id}, "
+            f"{_js_str(segment_html)}, {_js_str(tail_html)})"
+        )
 
     @Slot(str)
     def _on_thinking_delta(self, text: str):
@@ -1389,8 +2088,8 @@ class MainWindow(QMainWindow):
 
     @Slot(str, str, object)
     def _on_stream_finished(self, full_text: str, thinking_text: str, usage):
-        self.is_streaming = False
-        self._reset_send_button()
+        self._flush_timer.stop()
+        self._flush_stream()
 
         model_id = self.model_combo.currentData()
         cost = 0.0
@@ -1404,16 +2103,6 @@ class MainWindow(QMainWindow):
                 meta += f" / {usage.cache_read_tokens:,} cached"
             meta += f" | ${cost:.4f}"
 
-        if thinking_text.strip():
-            thinking_html = render_markdown(thinking_text)
-            escaped_thinking = escape_js_string(thinking_html)
-            self.chat_view.page().runJavaScript(f"addThinking('{escaped_thinking}')")
-
-        final_html = render_markdown(full_text)
-        escaped = escape_js_string(final_html)
-        escaped_meta = escape_js_string(meta)
-        escaped_raw = escape_js_string(full_text)  # 原始 Markdown
-
         if self.current_conv and full_text.strip():
             msg = self.conv_mgr.add_message(
                 self.current_conv.id, "assistant", full_text,
@@ -1424,10 +2113,25 @@ class MainWindow(QMainWindow):
                 cache_read_tokens=usage.cache_read_tokens if usage else 0,
                 cache_creation_tokens=usage.cache_creation_tokens if usage else 0,
                 cost_usd=cost,
+                defer=True,  # 不在 UI 线程上等待 COMMIT
             )
+            self._index_message(msg)
             msg_uid = msg.id
-            js_code = f"finishStreaming('{escaped}', '{escaped_meta}', '{msg_uid}', '{escaped_raw}')"
-            self.chat_view.page().runJavaScript(js_code)
+            if self._shutting_down:
+                # 退出中：回复已排队入库，不再启动渲染/统计/压缩任务
+                return
+            # 全文与思考内容在线程池中渲染；完成前 is_streaming 保持为 True，
+            # 防止新的流式请求在页面收尾前开始
+            QThreadPool.globalInstance().start(_FinalRenderTask({
+                "conversation_id": self.current_conv.id, "stream_id": self._stream_id,
+                "uid": msg_uid, "meta": meta,
+                "full_text": full_text, "thinking_text": thinking_text,
+            }, self.final_rendered))
+        else:
+            self._end_streaming()
+            thinking_html = render_markdown(thinking_text) if thinking_text.strip() else ""
+            # 空回复（提前取消等）：不渲染，只收起流式区域
+            self._run_js(f"finalizeMessage({self._stream_id}, {_js_str(thinking_html)}, null)")
 
         self._update_stats()
         self.statusBar().showMessage(f"Done | UID: {msg_uid[:8]}" if msg_uid else "Done")
@@ -1436,64 +2140,53 @@ class MainWindow(QMainWindow):
         # PRD v3: 触发后台压缩 (异步)
         self._trigger_compression()
 
+    @Slot(dict)
+    def _on_final_rendered(self, result: dict):
+        self._end_streaming()
+        # 重新打开对话时直接复用这次渲染结果
+        self._remember_message_html(result["uid"], result["final_html"])
+        # 渲染期间切换了对话：消息已入库，重新打开时从历史加载
+        if not self.current_conv or self.current_conv.id != result["conversation_id"]:
+            return
+        stream_id = result["stream_id"]
+        args = (result["thinking_html"], result["final_html"], result["meta"],
+                result["uid"], result["full_text"])
+        bridge = self._chat_page.bridge
+        if bridge.ready:
+            # 大段 HTML 作为信号参数直接传给页面，无需转义成 JS 源码再解析
+            bridge.streamFinished.emit(stream_id, *args)
+        else:
+            # 思考内容 + 最终消息合并为一次 runJavaScript
+            self._run_js(f"finalizeMessage({stream_id}, {', '.join(_js_str(a) for a in args)})")
+
     def _trigger_compression(self):
         """
         触发后台压缩 (PRD v3 核心功能)
         
-        在用户收到回复后异步执行，不阻塞主流程
+        在用户收到回复后于线程池中检查并执行，不阻塞主流程
         """
-        if not self.current_conv or not self.current_project:
-            return
-        
-        compressor = ContextCompressor()
-        
-        # 检查是否需要压缩
-        if not compressor.should_compress(self.current_conv.id):
+        if not self.current_conv or not self.current_project or self._shutting_down:
             return
-        
-        # 显示压缩开始状态
-        self.statusBar().showMessage("正在整理历史记忆... (Haiku)", 3000)
-        log.info("Starting background compression for conversation %s", self.current_conv.id[:8])
-        
-        # 使用 threading 异步执行压缩，避免阻塞 UI
-        import threading
-        
-        def run_compression():
-            from core.context_compressor import ContextCompressor
-            compressor = ContextCompressor()
-            
-            if not compressor.should_compress(self.current_conv.id):
-                return
-            
-            try:
-                result = compressor.compress(self.current_conv.id, self.current_project.name)
-                
-                # 在主线程更新 UI - 使用 QTimer.singleShot 代替 QMetaObject.invokeMethod
-                from PySide6.QtCore import QTimer
-                if result and result.success:
-                    saved = result.tokens_saved
-                    msg = f"历史记忆已更新，节省 {saved:,} tokens" if saved > 0 else "历史记忆已更新"
-                    QTimer.singleShot(0, lambda: self.statusBar().showMessage(msg, 5000))
-                    log.info("Compression complete: saved %d tokens", saved)
-                else:
-                    error_msg = result.error if result else "Unknown error"
-                    log.warning("Compression failed: %s", error_msg)
-            except Exception as e:
-                log.exception("Compression failed")
-        
-        # 启动后台线程
-        compression_thread = threading.Thread(target=run_compression, daemon=True)
-        compression_thread.start()
+        QThreadPool.globalInstance().start(_CompressionTask(
+            self.current_conv.id, self.current_project.name,
+            self.compression_status, self.compression_finished,
+        ))
+
+    @Slot(str)
+    def _on_compression_finished(self, message: str):
+        self._estimate_gen += 1  # 摘要已变化，仪表盘预估需重新计算
+        self.statusBar().showMessage(message, 5000)
+        self._update_stats()
 
     @Slot(str)
     def _on_stream_error(self, error_msg: str):
-        self.is_streaming = False
-        self._reset_send_button()
-        escaped = escape_js_string(error_msg)
+        self._flush_timer.stop()
+        self._flush_stream()
+        self._end_streaming()
         # #region agent log
         _dlog("main_window.py:902", "runJS addError (stream)", {"error_has_quote": "'" in error_msg, "has_newline": "\n" in error_msg}, "H3")
         # #endregion
-        self.chat_view.page().runJavaScript(f"addError('{escaped}')")
+        self._run_js(f"addError({_js_str(error_msg)})")
         self.statusBar().showMessage(f"Error: {error_msg}")
         log.error("Stream error: %s", error_msg)
 
@@ -1502,71 +2195,90 @@ class MainWindow(QMainWindow):
             self.worker.cancel()
             self.statusBar().showMessage("Cancelled")
 
+    def _end_streaming(self):
+        """Leave streaming mode and run any stats refresh postponed while streaming."""
+        self.is_streaming = False
+        self._reset_send_button()
+        self._update_send_enabled()
+        if self._stats_dirty:
+            self._stats_timer.start()
+
     def _reset_send_button(self):
-        self.btn_send.setText("Send")
-        self.btn_send.setStyleSheet("QPushButton { background: #D97706; color: white; border-radius: 6px; font-weight: bold; }")
-        try:
-            self.btn_send.clicked.disconnect()
-        except RuntimeError:
-            pass
-        self.btn_send.clicked.connect(self._send_message)
+        # 只在状态变化时重新设置样式表，避免 Qt 重复解析 QSS
+        if self._send_btn_state != "send":
+            self.btn_send.setText("Send")
+            self.btn_send.setStyleSheet(self._SEND_BTN_QSS)
+            self._send_btn_state = "send"
+        self._set_send_button_handler(self._send_message)
+        self._cancel_shortcut.setEnabled(False)
+
+    def _update_send_enabled(self):
+        # 流式输出期间按钮是 Stop，始终可用；否则等附件编码全部完成
+        self.btn_send.setEnabled(self.is_streaming or not self._attach_encoding)
+
+    def _set_send_button_handler(self, handler):
+        """Swap the send button's click handler, disconnecting only the one we connected."""
+        if self._send_btn_handler == handler:
+            return
+        if self._send_btn_handler is not None:
+            self.btn_send.clicked.disconnect(self._send_btn_handler)
+        self.btn_send.clicked.connect(handler)
+        self._send_btn_handler = handler
 
     def _attach_files(self):
-        all_supported = (
-            "*.png *.jpg *.jpeg *.gif *.webp *.pdf *.txt *.md *.markdown "
-            "*.doc *.docx *.xlsx *.xls *.csv *.json *.html *.rtf"
-        )
-        filter_str = (
-            f"All supported ({all_supported});;"
-            "Images (*.png *.jpg *.jpeg *.gif *.webp);;"
-            "PDF (*.pdf);;"
-            "Text / Markdown (*.txt *.md *.markdown);;"
-            "Word (*.doc *.docx);;"
-            "Excel (*.xlsx *.xls);;"
-            "CSV (*.csv);;"
-            "Other (*.json *.html *.rtf);;"
-            "All Files (*)"
-        )
         paths, _ = QFileDialog.getOpenFileNames(
-            self, "Attach Files", "", filter_str,
+            self, "Attach Files", "", _ATTACH_FILTER,
         )
-        image_exts = (".png", ".jpg", ".jpeg", ".gif", ".webp")
-        image_media = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg",
-                       ".gif": "image/gif", ".webp": "image/webp"}
-        doc_media = {
-            ".pdf": "application/pdf", ".txt": "text/plain", ".md": "text/markdown",
-            ".markdown": "text/markdown", ".doc": "application/msword",
-            ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            ".xls": "application/vnd.ms-excel", ".csv": "text/csv",
-            ".json": "application/json", ".html": "text/html", ".rtf": "application/rtf",
-        }
+        pool = QThreadPool.globalInstance()
         for path in paths:
+            p = Path(path)
+            ext = p.suffix.lower()
+            kind = _ATTACH_TYPES.get(ext)
+            if kind is None:
+                self.statusBar().showMessage(f"Unsupported file type: {ext}", 3000)
+                continue
             try:
-                data = Path(path).read_bytes()
+                st = os.stat(path)
             except OSError as e:
-                QMessageBox.warning(self, "Attach Error", f"Cannot read file: {e}")
+                self._show_attach_error(str(e))
                 continue
-            b64 = base64.b64encode(data).decode()
-            ext = Path(path).suffix.lower()
-            name = Path(path).name
-            if ext in image_exts:
-                self.pending_attachments.append({
-                    "type": "image",
-                    "data": b64,
-                    "media_type": image_media.get(ext, "image/png"),
-                    "filename": name,
-                })
-            elif ext in doc_media:
-                self.pending_attachments.append({
-                    "type": "document",
-                    "data": b64,
-                    "media_type": doc_media[ext],
-                    "filename": name,
-                })
-            else:
-                self.statusBar().showMessage(f"Unsupported file type: {ext}", 3000)
-        self._update_attachment_ui()
+            seq = self._attach_seq
+            self._attach_seq += 1
+            key = (path, st.st_mtime_ns, st.st_size)
+            cached = self._attach_cache.get(key)
+            if cached is not None:
+                self._attach_cache.move_to_end(key)
+                self._on_attachment_encoded(dict(cached), None, seq)
+                continue
+            attachment = {"type": kind[0], "media_type": kind[1], "filename": p.name}
+            # 读取 + 编码放到线程池，完成后经 attachment_encoded 信号按序号放入待发送列表
+            self._attach_encoding += 1
+            pool.start(_AttachEncodeTask(path, attachment, key, seq,
+                                         self.attachment_encoded, self.attachment_failed))
+        self._update_send_enabled()
+
+    @Slot(dict, object, int)
+    def _on_attachment_encoded(self, attachment: dict, cache_key: tuple | None, seq: int):
+        if cache_key is not None:  # 来自线程池（缓存命中时为 None）
+            self._attach_encoding -= 1
+            self._update_send_enabled()
+            self._attach_cache[cache_key] = dict(attachment)
+            if len(self._attach_cache) > _ATTACH_CACHE_SIZE:
+                self._attach_cache.popitem(last=False)
+        # 按选择顺序插入，只新增这一个 chip，不重建已有的
+        index = bisect_right(self._attach_order, seq)
+        self._attach_order.insert(index, seq)
+        self.pending_attachments.insert(index, attachment)
+        self._add_attachment_chip(attachment, index)
+
+    @Slot(str, str)
+    def _on_attachment_failed(self, path: str, error: str):
+        self._attach_encoding -= 1
+        self._update_send_enabled()
+        self._show_attach_error(error)
+
+    def _show_attach_error(self, error: str):
+        QMessageBox.warning(self, "Attach Error", f"Cannot read file: {error}")
 
     def _expand_uid_refs_in_message(self, text: str) -> str:
         """Expand only @#uid references (explicit ref syntax) into message content for the LLM.
@@ -1574,23 +2286,21 @@ class MainWindow(QMainWindow):
         if not self.current_conv or not text:
             return text
         # Only match explicit reference syntax: @#uid (8 hex or full UUID)
-        refs = re.findall(
-            r"@#([0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})?)",
-            text,
-        )
-        refs = list(dict.fromkeys(refs))
+        refs = list(dict.fromkeys(m.group(1) for m in _UID_REF_RE.finditer(text)))
         if not refs:
             return text
         messages = self.conv_mgr.get_messages(self.current_conv.id)
         id_to_msg = {m.id: m for m in messages}
+        # 8 位短引用按前缀查表，每次只建一次索引；同一前缀保留最早的消息
+        prefix_to_msg: dict[str, Message] = {}
+        for m in messages:
+            prefix_to_msg.setdefault(m.id[:8], m)
+            prefix_to_msg.setdefault(m.id.replace("-", "")[:8], m)
         parts = ["【以下为用户通过 @#uid 引用的消息原文，供参考】"]
         for ref in refs:
             msg = id_to_msg.get(ref)
             if not msg and len(ref) == 8:
-                for mid, m in id_to_msg.items():
-                    if mid.startswith(ref) or mid.replace("-", "").startswith(ref):
-                        msg = m
-                        break
+                msg = prefix_to_msg.get(ref)
             if msg:
                 parts.append(f"【消息 @#{ref[:8]}】\n{msg.content}")
         if len(parts) <= 1:
@@ -1601,52 +2311,74 @@ class MainWindow(QMainWindow):
 
     def _clear_attachments(self):
         self.pending_attachments.clear()
+        self._attach_order.clear()
         self._update_attachment_ui()
 
     def _remove_attachment(self, index: int):
         if 0 <= index < len(self.pending_attachments):
             self.pending_attachments.pop(index)
-            self._update_attachment_ui()
+            self._attach_order.pop(index)
+            # 只删除对应的 chip，其余 chip 保留
+            self._chip_widgets.pop(index).deleteLater()
+
+    def _remove_attachment_chip(self, chip: QFrame):
+        # chip 按对象定位：前面的附件被删除后索引会变化；
+        # 已移除的 chip（deleteLater 之前的重复点击、清空后迟到的点击）直接忽略
+        if chip in self._chip_widgets:
+            self._remove_attachment(self._chip_widgets.index(chip))
 
     def _update_attachment_ui(self):
-        while self.attach_list_layout.count():
-            item = self.attach_list_layout.takeAt(0)
-            if item.widget():
-                item.widget().deleteLater()
-        for i, att in enumerate(self.pending_attachments):
-            name = att.get("filename", "?")
-            chip = QFrame()
-            chip.setStyleSheet("QFrame { background: #3A3A3A; border-radius: 4px; padding: 2px 6px; }")
-            chip_layout = QHBoxLayout(chip)
-            chip_layout.setContentsMargins(6, 2, 2, 2)
-            chip_layout.setSpacing(4)
-            lbl = QLabel(name)
-            lbl.setStyleSheet("color: #CCC; font-size: 11px; max-width: 200px;")
-            lbl.setToolTip(name)
-            lbl.setWordWrap(False)
-            chip_layout.addWidget(lbl)
-            btn = QPushButton("\u00D7")
-            btn.setFixedSize(22, 22)
-            btn.setStyleSheet(
-                "QPushButton { color: #AAA; font-size: 16px; font-weight: bold; "
-                "background: transparent; border: 1px solid #555; border-radius: 4px; } "
-                "QPushButton:hover { color: #E74C3C; border-color: #E74C3C; background: #3A2020; }"
-            )
-            btn.setToolTip("Remove this file")
-            idx = i
-            btn.clicked.connect(lambda checked=False, idx=idx: self._remove_attachment(idx))
-            chip_layout.addWidget(btn)
-            self.attach_list_layout.addWidget(chip)
+        """Sync chips with pending_attachments: drop surplus chips, append missing ones."""
+        container = self.attach_list_container
+        container.setUpdatesEnabled(False)
+        try:
+            while len(self._chip_widgets) > len(self.pending_attachments):
+                self._chip_widgets.pop().deleteLater()
+            for att in self.pending_attachments[len(self._chip_widgets):]:
+                self._add_attachment_chip(att)
+        finally:
+            container.setUpdatesEnabled(True)
+
+    def _add_attachment_chip(self, att: dict, index: int | None = None):
+        name = att.get("filename", "?")
+        chip = QFrame()
+        chip.setObjectName("attachChip")
+        chip_layout = QHBoxLayout(chip)
+        chip_layout.setContentsMargins(6, 2, 2, 2)
+        chip_layout.setSpacing(4)
+        lbl = QLabel(name)
+        lbl.setObjectName("attachChipLabel")
+        lbl.setToolTip(name)
+        lbl.setWordWrap(False)
+        chip_layout.addWidget(lbl)
+        btn = QPushButton("\u00D7")
+        btn.setFixedSize(22, 22)
+        btn.setObjectName("attachChipRemove")
+        btn.setToolTip("Remove this file")
+        btn.clicked.connect(lambda checked=False, c=chip: self._remove_attachment_chip(c))
+        chip_layout.addWidget(btn)
+        if index is None:
+            index = len(self._chip_widgets)
+        self.attach_list_layout.insertWidget(index, chip)
+        self._chip_widgets.insert(index, chip)
 
     def _save_system_prompt(self):
         if not self.current_project:
             return
         prompt = self.system_prompt_edit.toPlainText()
-        self.project_mgr.update(self.current_project.id, system_prompt=prompt)
+        # 先更新内存中的项目，写库放到线程池
         self.current_project.system_prompt = prompt
+        self._system_tokens_by_project[self.current_project.id] = len(prompt) // 4
+        QThreadPool.globalInstance().start(_SystemPromptSaveTask(
+            self.project_mgr, self.current_project.id, prompt, self.system_prompt_save_failed,
+        ))
         self.statusBar().showMessage("System prompt saved")
         log.info("Saved system prompt for project %s", self.current_project.name)
 
+    @Slot(str)
+    def _on_system_prompt_save_failed(self, error: str):
+        QMessageBox.warning(self, "Save Error", f"Failed to save system prompt: {error}")
+
     def _open_settings(self):
         dlg = SettingsDialog(self.client, self)
         dlg.settings_changed.connect(self._on_settings_changed)
@@ -1654,40 +2386,60 @@ class MainWindow(QMainWindow):
 
     def _on_settings_changed(self):
         # PRD v3 §8.5: 主题切换支持
-        from utils.theme_manager import LIGHT_THEME, DARK_THEME
-        import json
-        from pathlib import Path
+        from utils.theme_manager import get_theme
         
         # 重新加载主题
+        _theme_colors.cache_clear()
         try:
-            theme_file = Path.home() / "ClaudeStation" / "theme_config.json"
+            theme_file = THEME_CONFIG_FILE
             if theme_file.exists():
                 with open(theme_file, "r", encoding="utf-8") as f:
                     theme_data = json.load(f)
                     theme_mode = theme_data.get("mode", "dark")
                     
-                    # 获取 QApplication 实例
-                    from PySide6.QtWidgets import QApplication
+                    # 主题未变化时不重新设置样式表，避免整树重新解析/polish
                     app = QApplication.instance()
-                    
-                    if theme_mode == "light":
-                        app.setStyleSheet(LIGHT_THEME)
-                    else:
-                        app.setStyleSheet(DARK_THEME)
+                    css = get_theme(theme_mode)
+                    if app.styleSheet() != css:
+                        app.setStyleSheet(css)
         except Exception as e:
             log.warning(f"Failed to apply theme: {e}")
         
+        render_markdown.cache_clear()
+        self._md_cache.clear()  # 按消息缓存的 HTML 同样依赖渲染设置
         self._init_client()
         self.statusBar().showMessage("Settings updated")
 
     def closeEvent(self, event):
+        if self._shutdown_complete:
+            log.info("Application closed")
+            event.accept()
+            return
+        # 等待各线程池、写入延迟队列、WAL checkpoint 放到独立线程池，UI 不卡顿
+        event.ignore()
+        if self._shutting_down:
+            return
+        self._shutting_down = True
+        self.setEnabled(False)
+        self.statusBar().showMessage("Closing...")
+        # 先让流式请求尽快结束，再等待各线程池
         if self.worker and self.worker.isRunning():
             self.worker.cancel()
-            self.worker.wait(2000)
-        from data.database import db
-        db.close()
-        log.info("Application closed")
-        event.accept()
+        pools = (self._api_pool, self._stats_pool, QThreadPool.globalInstance())
+        self._shutdown_pool = QThreadPool(self)
+        self._shutdown_pool.setMaxThreadCount(1)
+        self._shutdown_pool.start(_DrainPoolsTask(pools, self.pools_drained))
+
+    @Slot(bool)
+    def _on_pools_drained(self, all_done: bool):
+        # 此时 worker 在结束前发出的 finished 信号已先于本信号处理（回复已排队入库），
+        # 再关闭数据库
+        self._shutdown_pool.start(_ShutdownTask(all_done, self.shutdown_done))
+
+    @Slot()
+    def _on_shutdown_done(self):
+        self._shutdown_complete = True
+        self.close()
 
 
 
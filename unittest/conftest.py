@@ -14,6 +14,9 @@ import pytest
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
+# 全局 db 单例使用内存数据库，测试不触碰用户的真实数据库文件
+os.environ.setdefault("CS_DB_PATH", ":memory:")
+
 
 @pytest.fixture
 def temp_dir():
@@ -1,10 +1,14 @@
 """Integration Test Runner for ClaudeStation PRD v3"""
+import os
 import sys
 from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
+# 全局 db 单例使用内存数据库，测试不触碰用户的真实数据库文件
+os.environ.setdefault("CS_DB_PATH", ":memory:")
+
 if __name__ == "__main__":
     import unittest
     # Discover and run integration tests
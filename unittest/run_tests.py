@@ -7,10 +7,14 @@ Usage:
     python run_tests.py              # Run all tests
     python run_tests.py test_config # Run specific test module
 """
+import os
 import sys
 import unittest
 from pathlib import Path
 
+# 全局 db 单例使用内存数据库，测试不触碰用户的真实数据库文件
+os.environ.setdefault("CS_DB_PATH", ":memory:")
+
 # Add project root to path
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
@@ -356,7 +356,7 @@ class TestConversationEdgeCases(unittest.TestCase):
         """测试获取空消息列表"""
         from core.conversation_manager import ConversationManager
         
-        mock_db.execute.return_value = []
+        mock_db.execute_tuples.return_value = []
         
         mgr = ConversationManager()
         messages = mgr.get_messages("conv-001")
@@ -369,25 +369,24 @@ class TestConversationEdgeCases(unittest.TestCase):
         from core.conversation_manager import ConversationManager
         
         # 模拟子查询结果
+        # 元组列顺序与 _MESSAGE_COLUMNS 一致
         mock_rows = [
-            {"id": "msg-001", "conversation_id": "conv-001", "role": "user",
-             "content": "Hello", "thinking_content": None, "attachments_json": "[]",
-             "model_used": None, "input_tokens": 10, "output_tokens": 20,
-             "cache_read_tokens": 0, "cache_creation_tokens": 0, "cost_usd": 0.0,
-             "created_at": "2026-01-01T00:00:00"},
-            {"id": "msg-002", "conversation_id": "conv-001", "role": "assistant",
-             "content": "Hi there", "thinking_content": None, "attachments_json": "[]",
-             "model_used": "claude-sonnet-4-5-20250929", "input_tokens": 20,
-             "output_tokens": 15, "cache_read_tokens": 10, "cache_creation_tokens": 50,
-             "cost_usd": 0.001, "created_at": "2026-01-01T00:00:01"},
+            ("msg-001", "conv-001", "user", "Hello", None, "[]", None,
+             10, 20, 0, 0, 0.0, "2026-01-01T00:00:00"),
+            ("msg-002", "conv-001", "assistant", "Hi there", None, "[]",
+             "claude-sonnet-4-5-20250929", 20, 15, 10, 50, 0.001,
+             "2026-01-01T00:00:01"),
         ]
         
-        mock_db.execute.return_value = mock_rows
+        mock_db.execute_tuples.return_value = mock_rows
         
         mgr = ConversationManager()
         messages = mgr.get_messages("conv-001", limit=5)
         
         self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[1].model_used, "claude-sonnet-4-5-20250929")
+        self.assertEqual(messages[1].cache_creation_tokens, 50)
+        self.assertEqual(messages[0].thinking_content, "")
     
     @patch("core.conversation_manager.db")
     def test_conversation_stats(self, mock_db):
@@ -410,6 +409,95 @@ class TestConversationEdgeCases(unittest.TestCase):
         self.assertEqual(stats["total_input"], 1000)
         self.assertEqual(stats["total_cost"], 0.05)
 
+    
+    @patch("core.conversation_manager.db")
+    def test_message_count(self, mock_db):
+        """测试消息计数只走 COUNT 查询"""
+        from core.conversation_manager import ConversationManager
+        
+        mock_db.execute_one.return_value = (3,)
+        
+        mgr = ConversationManager()
+        self.assertEqual(mgr.message_count("conv-001"), 3)
+        sql = mock_db.execute_one.call_args[0][0]
+        self.assertIn("COUNT(1)", sql)
+        mock_db.execute.assert_not_called()
+    
+    @patch("core.conversation_manager.db")
+    def test_message_count_no_row(self, mock_db):
+        """测试查询无结果时返回 0"""
+        from core.conversation_manager import ConversationManager
+        
+        mock_db.execute_one.return_value = None
+        
+        self.assertEqual(ConversationManager().message_count("conv-001"), 0)
+    
+    @patch("core.conversation_manager.db")
+    def test_add_message_deferred(self, mock_db):
+        """测试 defer=True 时写入进入延迟队列而不是立即提交"""
+        from core.conversation_manager import ConversationManager
+        
+        msg = ConversationManager().add_message("conv-001", "assistant", "hi", defer=True)
+        
+        self.assertEqual(mock_db.defer.call_count, 2)
+        insert_sql, insert_params = mock_db.defer.call_args_list[0][0]
+        self.assertIn("INSERT INTO messages", insert_sql)
+        self.assertEqual(insert_params[0], msg.id)
+        mock_db.execute.assert_not_called()
+        mock_db.transaction.assert_not_called()
+
+class TestFullStats(unittest.TestCase):
+    """测试 get_full_stats 在真实数据库上与分开查询的结果一致"""
+
+    def setUp(self):
+        from data.database import Database, MEMORY_DB
+
+        self.db = Database(MEMORY_DB)
+        self.db.initialize()
+        self.db.execute("INSERT INTO projects (id, name) VALUES ('p1', 'P')")
+        self.db.execute("INSERT INTO conversations (id, project_id) VALUES ('c1', 'p1')")
+        patcher = patch("core.conversation_manager.db", self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.db.close)
+        self.mgr = ConversationManager()
+
+    def _add(self, n):
+        ids = []
+        for i in range(n):
+            msg = self.mgr.add_message("c1", "user" if i % 2 == 0 else "assistant",
+                                       f"m{i}", input_tokens=10, cost_usd=0.5)
+            ids.append(msg.id)
+        return ids
+
+    def test_full_stats_matches_separate_queries(self):
+        ids = self._add(6)
+        self.db.execute(
+            "INSERT INTO api_call_log (conversation_id, cache_read_tokens) VALUES ('c1', 100), ('c1', 0)"
+        )
+        self.mgr.update_rolling_summary("c1", "summary", ids[1], 42)
+
+        stats = self.mgr.get_full_stats("c1")
+
+        for key, value in self.mgr.get_conversation_stats("c1").items():
+            self.assertEqual(stats[key], value, key)
+        compression = self.mgr.get_compression_stats("c1")
+        for key in ("has_summary", "summary_tokens", "uncompressed_count",
+                    "uncompressed_turns", "should_compress"):
+            self.assertEqual(stats[key], compression[key], key)
+        self.assertEqual(stats["uncompressed_count"], 4)
+        self.assertEqual((stats["api_calls"], stats["cache_hits"], stats["api_cache_read"]), (2, 1, 100))
+
+    def test_full_stats_without_summary_or_calls(self):
+        self._add(3)
+
+        stats = self.mgr.get_full_stats("c1")
+
+        self.assertFalse(stats["has_summary"])
+        self.assertEqual(stats["uncompressed_count"], 3)
+        self.assertEqual(stats["api_calls"], 0)
+        self.assertEqual(stats["cache_hits"], 0)
+
 
 class TestArchiveAndDelete(unittest.TestCase):
     """测试归档和删除"""
@@ -13,7 +13,7 @@ from unittest.mock import patch, MagicMock
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from data.database import Database, SCHEMA_VERSION
+from data.database import Database, SCHEMA_VERSION, SCHEMA_HASH
 
 
 class TestDatabaseSchema(unittest.TestCase):
@@ -35,7 +35,7 @@ class TestDatabaseSchema(unittest.TestCase):
     
     def test_schema_version(self):
         """测试 Schema 版本"""
-        self.assertEqual(SCHEMA_VERSION, 3)
+        self.assertEqual(SCHEMA_VERSION, 6)
     
     def test_initialize_schema(self):
         """测试 Schema 初始化"""
@@ -43,7 +43,7 @@ class TestDatabaseSchema(unittest.TestCase):
         
         # 验证版本表
         row = self.db.execute_one("SELECT version FROM schema_version")
-        self.assertEqual(row["version"], 3)
+        self.assertEqual(row["version"], SCHEMA_VERSION)
         
         # 验证表存在
         tables = self.db.execute(
@@ -59,6 +59,27 @@ class TestDatabaseSchema(unittest.TestCase):
         self.assertIn("api_keys", table_names)
         self.assertIn("api_call_log", table_names)
     
+    def test_initialize_skips_ddl_when_hash_matches(self):
+        """测试 schema 指纹一致时 initialize() 跳过 DDL，指纹变化时重新执行"""
+        self.db.initialize()
+        row = self.db.execute_one("SELECT version, schema_hash FROM schema_version")
+        self.assertEqual(row["version"], SCHEMA_VERSION)
+        self.assertEqual(row["schema_hash"], SCHEMA_HASH)
+        
+        # 指纹一致：删除的索引不会被重建
+        self.db.execute("DROP INDEX idx_messages_created")
+        self.db.initialize()
+        names = {r["name"] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        self.assertNotIn("idx_messages_created", names)
+        
+        # 指纹变化（模拟 SCHEMA_SQL 被修改）：重新执行 DDL 并写回新指纹
+        self.db.execute("UPDATE schema_version SET schema_hash = 'stale'")
+        self.db.initialize()
+        names = {r["name"] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        self.assertIn("idx_messages_created", names)
+        row = self.db.execute_one("SELECT schema_hash FROM schema_version")
+        self.assertEqual(row["schema_hash"], SCHEMA_HASH)
+    
     def test_conversations_table_columns(self):
         """测试 conversations 表字段"""
         self.db.initialize()
@@ -172,7 +193,7 @@ class TestDatabaseMigration(unittest.TestCase):
         
         # 验证迁移后的版本
         row = self.db.execute_one("SELECT version FROM schema_version")
-        self.assertEqual(row["version"], 3)
+        self.assertEqual(row["version"], SCHEMA_VERSION)
         
         # 验证新字段已添加
         rows = self.db.execute("PRAGMA table_info(conversations)")
@@ -246,7 +267,7 @@ class TestDatabaseMigration(unittest.TestCase):
         
         # 验证版本
         row = self.db.execute_one("SELECT version FROM schema_version")
-        self.assertEqual(row["version"], 3)
+        self.assertEqual(row["version"], SCHEMA_VERSION)
         
         # 验证压缩字段
         rows = self.db.execute("PRAGMA table_info(conversations)")
@@ -255,6 +276,70 @@ class TestDatabaseMigration(unittest.TestCase):
         self.assertIn("rolling_summary", columns)
         self.assertIn("summary_token_count", columns)
 
+    
+    def test_migration_from_v3_rebuilds_api_log_indexes(self):
+        """测试从 v3 迁移时 api_call_log 索引重建为覆盖索引"""
+        conn = self.db._get_connection()
+        conn.executescript("""
+            CREATE TABLE schema_version (version INTEGER);
+            INSERT INTO schema_version (version) VALUES (3);
+            
+            CREATE TABLE api_call_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                project_id TEXT,
+                conversation_id TEXT,
+                model_id TEXT,
+                cache_read_tokens INTEGER DEFAULT 0,
+                cache_creation_tokens INTEGER DEFAULT 0,
+                input_tokens INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX idx_api_log_project ON api_call_log(project_id, created_at DESC);
+            CREATE INDEX idx_api_log_conversation ON api_call_log(conversation_id, created_at DESC);
+        """)
+        conn.commit()
+        
+        self.db.initialize()
+        
+        for name in ("idx_api_log_project", "idx_api_log_conversation"):
+            cols = [r["name"] for r in self.db.execute(f"PRAGMA index_info({name})")]
+            self.assertEqual(cols[2:], ["cache_read_tokens", "cache_creation_tokens", "input_tokens"])
+    
+    def test_migration_from_v5_adds_project_model_index(self):
+        """测试从 v5 迁移时添加 (project_id, model_id) 索引，模型切换查询走索引"""
+        conn = self.db._get_connection()
+        conn.executescript("""
+            CREATE TABLE schema_version (version INTEGER, schema_hash TEXT);
+            INSERT INTO schema_version (version, schema_hash) VALUES (5, 'v5');
+            
+            CREATE TABLE api_call_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                project_id TEXT,
+                conversation_id TEXT,
+                model_id TEXT,
+                cache_read_tokens INTEGER DEFAULT 0,
+                cache_creation_tokens INTEGER DEFAULT 0,
+                input_tokens INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+        
+        self.db.initialize()
+        
+        cols = [r["name"] for r in self.db.execute("PRAGMA index_info(idx_api_log_project_model)")]
+        self.assertEqual(cols[:3], ["project_id", "model_id", "created_at"])
+        plan = " ".join(
+            r["detail"] for r in self.db.execute(
+                "EXPLAIN QUERY PLAN SELECT cache_read_tokens, cache_creation_tokens "
+                "FROM api_call_log WHERE project_id = ? AND model_id = ? "
+                "ORDER BY created_at DESC LIMIT 5",
+                ("p", "m"),
+            )
+        )
+        self.assertIn("idx_api_log_project_model", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
 
 class TestDatabaseCRUD(unittest.TestCase):
     """测试数据库 CRUD 操作"""
@@ -396,6 +481,7 @@ class TestDatabaseIndexes(unittest.TestCase):
         self.assertTrue(any("messages_created" in n for n in index_names))
         self.assertTrue(any("api_log_project" in n for n in index_names))
         self.assertTrue(any("api_log_conversation" in n for n in index_names))
+        self.assertIn("idx_api_log_project_model", index_names)
 
 
 class TestDatabaseEdgeCases(unittest.TestCase):
@@ -477,6 +563,199 @@ class TestDatabaseEdgeCases(unittest.TestCase):
         msg = self.db.execute_one("SELECT * FROM messages WHERE id = ?", (mid,))
         self.assertIsNone(msg)
 
+    def test_transaction_commits_once(self):
+        """测试 transaction() 内的多次写入在退出时一起提交（含嵌套）"""
+        now = "2026-01-01T00:00:00"
+        with self.db.transaction():
+            for i in range(3):
+                self.db.execute(
+                    "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (f"p{i}", "Test", "claude-sonnet-4-5-20250929", now, now)
+                )
+            with self.db.transaction():
+                self.db.execute("UPDATE projects SET name = ? WHERE id = ?", ("Renamed", "p0"))
+            self.assertTrue(self.db._get_connection().in_transaction)
+        
+        self.assertFalse(self.db._get_connection().in_transaction)
+        rows = self.db.execute("SELECT id FROM projects")
+        self.assertEqual(len(rows), 3)
+    
+    def test_transaction_rolls_back_on_error(self):
+        """测试 transaction() 异常时整体回滚"""
+        now = "2026-01-01T00:00:00"
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.execute(
+                    "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    ("p1", "Test", "claude-sonnet-4-5-20250929", now, now)
+                )
+                raise ValueError("boom")
+        
+        rows = self.db.execute("SELECT id FROM projects")
+        self.assertEqual(len(rows), 0)
+    
+    def test_in_memory_database(self):
+        """测试 ":memory:" 数据库可初始化且不启用 WAL"""
+        mem = Database(":memory:")
+        try:
+            mem.initialize()
+            row = mem.execute_one("SELECT version FROM schema_version")
+            self.assertEqual(row["version"], SCHEMA_VERSION)
+            mode = mem.execute_one("PRAGMA journal_mode")[0]
+            self.assertEqual(mode, "memory")
+        finally:
+            mem.close()
+    
+    def test_db_path_env_override(self):
+        """测试 CS_DB_PATH 环境变量覆盖默认路径"""
+        with patch.dict(os.environ, {"CS_DB_PATH": ":memory:"}):
+            self.assertEqual(Database().db_path, ":memory:")
+        # 显式传入的路径优先
+        with patch.dict(os.environ, {"CS_DB_PATH": ":memory:"}):
+            self.assertEqual(Database(Path(self.temp_db.name)).db_path, Path(self.temp_db.name))
+    
+    def test_execute_tuples_returns_plain_tuples(self):
+        """测试 execute_tuples 返回普通元组且不影响其他查询的 Row 工厂"""
+        now = "2026-01-01T00:00:00"
+        self.db.execute(
+            "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            ("p1", "Test", "claude-sonnet-4-5-20250929", now, now)
+        )
+        
+        rows = self.db.execute_tuples("SELECT id, name FROM projects")
+        self.assertEqual(rows, [("p1", "Test")])
+        self.assertIs(type(rows[0]), tuple)
+        
+        row = self.db.execute_one("SELECT id, name FROM projects")
+        self.assertEqual(row["name"], "Test")
+    
+    def test_deferred_writes_visible_to_next_read(self):
+        """测试 defer() 排队的写入在下一次读取前落盘"""
+        now = "2026-01-01T00:00:00"
+        sql = "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+        for i in range(3):
+            self.db.defer(sql, (f"p{i}", "Test", "claude-sonnet-4-5-20250929", now, now))
+        self.assertEqual(len(self.db._pending), 3)
+        
+        rows = self.db.execute("SELECT id FROM projects ORDER BY id")
+        self.assertEqual([r["id"] for r in rows], ["p0", "p1", "p2"])
+        self.assertEqual(self.db._pending, [])
+    
+    def test_deferred_writes_flush_at_threshold(self):
+        """测试排队写入达到阈值时立即提交"""
+        from data.database import WRITE_FLUSH_THRESHOLD
+        now = "2026-01-01T00:00:00"
+        sql = "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+        for i in range(WRITE_FLUSH_THRESHOLD):
+            self.db.defer(sql, (f"p{i}", "Test", "claude-sonnet-4-5-20250929", now, now))
+        
+        self.assertEqual(self.db._pending, [])
+        count = self.db._get_connection().execute("SELECT COUNT(*) FROM projects").fetchone()[0]
+        self.assertEqual(count, WRITE_FLUSH_THRESHOLD)
+    
+    def test_failed_flush_keeps_deferred_writes(self):
+        """测试库被锁导致 flush 失败时，排队的写入保留并在之后重试成功"""
+        import sqlite3
+        now = "2026-01-01T00:00:00"
+        self.db._get_connection().execute("PRAGMA busy_timeout=0")
+        self.db.defer(
+            "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            ("p1", "Test", "claude-sonnet-4-5-20250929", now, now)
+        )
+        
+        other = sqlite3.connect(self.temp_db.name)
+        other.execute("BEGIN IMMEDIATE")
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                self.db.flush()
+            self.assertEqual(len(self.db._pending), 1)
+            # 定时器线程上的失败只记录日志，不抛出
+            self.db._timer_flush()
+            self.assertEqual(len(self.db._pending), 1)
+        finally:
+            other.rollback()
+            other.close()
+        
+        self.db.flush()
+        self.assertEqual(self.db._pending, [])
+        rows = self.db.execute("SELECT id FROM projects")
+        self.assertEqual([r["id"] for r in rows], ["p1"])
+    
+    def test_flush_drops_only_failing_rows_on_constraint_error(self):
+        """测试约束冲突时逐条重放：只丢弃冲突的那一条，同批其他写入保留"""
+        now = "2026-01-01T00:00:00"
+        sql = "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+        self.db.defer(sql, ("p1", "Test", "claude-sonnet-4-5-20250929", now, now))
+        self.db.defer(sql, ("p1", "Dup", "claude-sonnet-4-5-20250929", now, now))
+        self.db.defer(sql, ("p2", "Other", "claude-sonnet-4-5-20250929", now, now))
+        
+        self.db.flush()
+        self.assertEqual(self.db._pending, [])
+        rows = self.db.execute("SELECT id, name FROM projects ORDER BY id")
+        self.assertEqual([(r["id"], r["name"]) for r in rows], [("p1", "Test"), ("p2", "Other")])
+    
+    def test_read_survives_failed_deferred_flush(self):
+        """测试排队写入 flush 失败不会让无关的读取抛出异常，队列保留待重试"""
+        import sqlite3
+        now = "2026-01-01T00:00:00"
+        self.db._get_connection().execute("PRAGMA busy_timeout=0")
+        self.db.defer(
+            "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            ("p1", "Test", "claude-sonnet-4-5-20250929", now, now)
+        )
+        
+        other = sqlite3.connect(self.temp_db.name)
+        other.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute("SELECT id FROM projects")
+            self.assertEqual(rows, [])
+            self.assertEqual(len(self.db._pending), 1)
+        finally:
+            other.rollback()
+            other.close()
+    
+    def test_close_flushes_deferred_writes(self):
+        """测试 close() 前写入排队的语句"""
+        now = "2026-01-01T00:00:00"
+        self.db.defer(
+            "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            ("p1", "Test", "claude-sonnet-4-5-20250929", now, now)
+        )
+        self.db.close()
+        
+        conn = sqlite3.connect(self.temp_db.name)
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM projects").fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(count, 1)
+    
+    def test_close_always_closes_and_never_reopens(self):
+        """测试 flush 失败时 close() 仍关闭连接，之后的读写/定时 flush 不会重新打开"""
+        now = "2026-01-01T00:00:00"
+        self.db._get_connection().execute("PRAGMA busy_timeout=0")
+        self.db.defer(
+            "INSERT INTO projects (id, name, default_model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            ("p1", "Test", "claude-sonnet-4-5-20250929", now, now)
+        )
+        
+        other = sqlite3.connect(self.temp_db.name)
+        other.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.close()
+        finally:
+            other.rollback()
+            other.close()
+        
+        self.assertIsNone(self.db._conn)
+        self.assertIsNone(self.db._flush_timer)
+        self.db._timer_flush()
+        self.db.defer("DELETE FROM projects")
+        self.assertIsNone(self.db._conn)
+        self.assertEqual(self.db._pending, [])
+        with self.assertRaises(sqlite3.ProgrammingError):
+            self.db.execute("SELECT id FROM projects")
+
 
 if __name__ == "__main__":
     unittest.main()
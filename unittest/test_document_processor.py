@@ -305,6 +305,36 @@ class TestDocumentProcessorIntegration(unittest.TestCase):
         finally:
             os.unlink(temp_path)
     
+    def test_documents_with_total(self):
+        """Test document list with SQL-computed token total"""
+        from core.document_processor import DocumentProcessor
+        from core.project_manager import ProjectManager
+        
+        pm = ProjectManager()
+        project = pm.create("Test Project")
+        processor = DocumentProcessor()
+        
+        docs, total = processor.get_project_documents_with_total(project.id)
+        self.assertEqual(docs, [])
+        self.assertEqual(total, 0)
+        
+        paths = []
+        try:
+            for text in ("First document content.", "Second document, a bit longer."):
+                with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
+                    f.write(text)
+                    paths.append(f.name)
+                processor.add_document(project.id, paths[-1])
+            
+            docs, total = processor.get_project_documents_with_total(project.id)
+            self.assertEqual(len(docs), 2)
+            self.assertNotIn("extracted_text", docs[0])
+            self.assertEqual(total, sum(d["token_count"] for d in docs))
+            self.assertEqual(total, processor.get_total_tokens(project.id))
+        finally:
+            for path in paths:
+                os.unlink(path)
+    
     def test_remove_document(self):
         """Test removing a document"""
         from core.document_processor import DocumentProcessor
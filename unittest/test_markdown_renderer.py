@@ -52,6 +52,55 @@ class TestMarkdownRendererBasic(unittest.TestCase):
         self.assertIn("&lt;", result)  # < escaped
         self.assertIn("&gt;", result)  # > escaped
 
+    def test_render_is_cached(self):
+        """Test that repeated renders of the same text hit the cache"""
+        from utils.markdown_renderer import render_markdown, render_markdown_uncached
+
+        render_markdown.cache_clear()
+        first = render_markdown("cached **text**")
+        second = render_markdown("cached **text**")
+
+        self.assertIs(first, second)
+        self.assertEqual(render_markdown.cache_info().hits, 1)
+        self.assertEqual(first, render_markdown_uncached("cached **text**"))
+
+    def test_prewarm_leaves_render_cache_empty(self):
+        """Test that the warm-up parse does not go through the cached renderer"""
+        from utils.markdown_renderer import render_markdown, prewarm
+
+        render_markdown.cache_clear()
+        prewarm()
+
+        self.assertEqual(render_markdown.cache_info().currsize, 0)
+
+    def test_render_plain_text_fast_path(self):
+        """Test that text without markdown syntax skips the parser"""
+        from utils.markdown_renderer import render_markdown_uncached
+
+        result = render_markdown_uncached("first line\nsecond line\n\nnext paragraph")
+
+        # 与解析器输出一致：段内换行保留为 "\n"
+        self.assertEqual(
+            result, "<p>first line\nsecond line</p>\n<p>next paragraph</p>"
+        )
+
+    def test_render_plain_text_escapes_html(self):
+        """Test that the plain-text path still escapes markup characters"""
+        from utils.markdown_renderer import render_markdown_uncached
+
+        result = render_markdown_uncached("a > b")
+
+        self.assertEqual(result, "<p>a &gt; b</p>")
+
+    def test_markdown_syntax_uses_parser(self):
+        """Test that markdown syntax is not sent down the plain-text path"""
+        from utils.markdown_renderer import _MD_TRIGGERS
+
+        for text in ("**bold**", "`code`", "# title", "- item", "1. item", "> quote", "a | b",
+                     "hard  \nbreak"):
+            self.assertIsNotNone(_MD_TRIGGERS.search(text), text)
+        self.assertIsNone(_MD_TRIGGERS.search("just a sentence, nothing more."))
+
 
 class TestMarkdownRendererFull(unittest.TestCase):
     """Full tests for MarkdownRenderer - Edge cases and advanced features"""
@@ -185,47 +234,69 @@ class TestChatHtmlTemplate(unittest.TestCase):
         self.assertIn("copyMessageText", result)
 
 
-class TestEscapeJsString(unittest.TestCase):
-    """Tests for JavaScript string escaping"""
-    
-    def test_escape_single_quote(self):
-        """Test escaping single quotes"""
-        from utils.markdown_renderer import escape_js_string
-        
-        result = escape_js_string("It's a test")
-        
-        # Should escape single quotes
-        self.assertTrue("\\'" in result or "'" in result)
-    
-    def test_escape_newline(self):
-        """Test escaping newlines"""
-        from utils.markdown_renderer import escape_js_string
-        
-        result = escape_js_string("line1\nline2")
-        
-        # Should escape newline
-        self.assertTrue("\\n" in result or "\n" in result)
-    
-    def test_escape_backslash(self):
-        """Test escaping backslashes"""
-        from utils.markdown_renderer import escape_js_string
-        
-        result = escape_js_string("path\\to\\file")
-        
-        # Should escape backslash
-        self.assertTrue("\\\\" in result or result.count("\\") > 0)
-    
-    def test_escape_html_chars(self):
-        """Test that JS escaping works for quotes and newlines"""
-        from utils.markdown_renderer import escape_js_string
-        
-        # Test escaping quotes
-        result = escape_js_string('Hello "world"')
-        self.assertIn('\\"', result)
-        
-        # Test escaping newlines
-        result = escape_js_string("line1\nline2")
-        self.assertIn("\\n", result)
+class TestStreamRendering(unittest.TestCase):
+    """Tests for segment-level streaming rendering"""
+
+    def test_split_blocks_reassembles_text(self):
+        """Test that blocks concatenate back to the input"""
+        from utils.markdown_renderer import split_blocks
+
+        text = "para one\n\npara two\n\npartial"
+        blocks = split_blocks(text)
+
+        self.assertEqual(blocks, ["para one\n\n", "para two\n\n", "partial"])
+        self.assertEqual("".join(blocks), text)
+
+    def test_split_blocks_ignores_blank_lines_in_fence(self):
+        """Test that blank lines inside code fences do not split"""
+        from utils.markdown_renderer import split_blocks
+
+        text = "```python\na = 1\n\nb = 2\n```\n\ntail"
+        blocks = split_blocks(text)
+
+        self.assertEqual(blocks, ["```python\na = 1\n\nb = 2\n```\n\n", "tail"])
+
+    def test_split_blocks_open_fence_stays_in_tail(self):
+        """Test that an unterminated fence is never split"""
+        from utils.markdown_renderer import split_blocks
+
+        text = "intro\n\n```\ncode\n\nmore"
+        blocks = split_blocks(text)
+
+        self.assertEqual(blocks, ["intro\n\n", "```\ncode\n\nmore"])
+
+    def test_split_blocks_from_offset(self):
+        """Test splitting from a known block boundary"""
+        from utils.markdown_renderer import split_blocks
+
+        text = "a\n\nb\n\nc"
+        self.assertEqual(split_blocks(text, 3), ["b\n\n", "c"])
+
+    def test_stream_cache_emits_each_block_once(self):
+        """Test that completed blocks are returned once and the tail every time"""
+        from utils.markdown_renderer import StreamRenderCache, render_markdown_uncached
+
+        cache = StreamRenderCache()
+        new_html, tail_html = cache.update("first")
+        self.assertEqual(new_html, "")
+        self.assertEqual(tail_html, render_markdown_uncached("first"))
+
+        new_html, tail_html = cache.update("first\n\nsecond")
+        self.assertEqual(new_html, render_markdown_uncached("first\n\n"))
+        self.assertEqual(tail_html, render_markdown_uncached("second"))
+
+        new_html, _ = cache.update("first\n\nsecond more")
+        self.assertEqual(new_html, "")
+
+    def test_stream_cache_reset(self):
+        """Test that reset starts a new response"""
+        from utils.markdown_renderer import StreamRenderCache, render_markdown_uncached
+
+        cache = StreamRenderCache()
+        cache.update("old\n\ntext")
+        cache.reset()
+
+        self.assertEqual(cache.update("new"), ("", render_markdown_uncached("new")))
 
 
 if __name__ == "__main__":
@@ -113,6 +113,20 @@ class TestTokenTrackerCostCalculation(unittest.TestCase):
         # 使用 Sonnet 定价: 1000*3/1M + 500*15/1M = 0.003 + 0.0075 = 0.0105
         self.assertAlmostEqual(cost, 0.0105, places=4)
     
+    def test_calculate_cost_exact_micro_usd(self):
+        """测试成本按整数运算后精确落在微美元上"""
+        tracker = TokenTracker(cache_ttl="5m")
+        
+        # 1 token Sonnet 输入 = $0.000003，cache 读取 10 tokens = $0.000003
+        self.assertEqual(
+            tracker.calculate_cost("claude-sonnet-4-5-20250929", UsageInfo(input_tokens=1)),
+            0.000003,
+        )
+        self.assertEqual(
+            tracker.calculate_cost("claude-sonnet-4-5-20250929", UsageInfo(cache_read_tokens=10)),
+            0.000003,
+        )
+    
     def test_cache_ttl_switch(self):
         """测试缓存 TTL 切换"""
         tracker = TokenTracker(cache_ttl="5m")
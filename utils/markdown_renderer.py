@@ -1,20 +1,57 @@
 """Markdown to HTML rendering for chat display."""
 from __future__ import annotations
 
+import html as html_mod
 import logging
+import re
+import threading
+from functools import lru_cache
 
 log = logging.getLogger(__name__)
 
+# 可能触发 Markdown 语法的字符/行首标记（含行尾两个空格的硬换行）；
+# 都不出现时按纯文本处理，跳过解析器
+_MD_TRIGGERS = re.compile(
+    r"[`*_#\[\]|!~<&\\]|^[ \t]*(?:[-+>=]|\d+[.)])|^(?: {4}|\t)|  $", re.M
+)
+_BLANK_LINES = re.compile(r"\n[ \t]*\n\s*")
 
+
+def _plain_text_html(text: str) -> str:
+    """HTML for text without Markdown syntax, matching what the parser would produce.
+
+    每段一个 <p>；与解析器一致，段内单个换行保留为 "\n"，不转成 <br>。
+    """
+    return "\n".join(
+        "<p>%s</p>" % html_mod.escape(para, quote=False)
+        for para in _BLANK_LINES.split(text.strip())
+        if para
+    )
+
+
+@lru_cache(maxsize=512)
 def render_markdown(text: str) -> str:
-    """Convert markdown text to styled HTML fragment."""
-    try:
+    """Convert markdown text to styled HTML fragment (cached by content).
+
+    同一文本（流式结束后的全文、重新打开的历史消息）只解析一次；
+    样式变化时调用 render_markdown.cache_clear()。
+    """
+    return render_markdown_uncached(text)
+
+
+_md_local = threading.local()
+
+
+def _markdown_parser():
+    """Per-thread Markdown instance; building one loads every extension, so it is reused."""
+    md = getattr(_md_local, "md", None)
+    if md is None:
         import markdown
         from markdown.extensions.codehilite import CodeHiliteExtension
         from markdown.extensions.fenced_code import FencedCodeExtension
         from markdown.extensions.tables import TableExtension
-        
-        md = markdown.Markdown(
+
+        md = _md_local.md = markdown.Markdown(
             extensions=[
                 FencedCodeExtension(),
                 CodeHiliteExtension(css_class="highlight", linenums=False, guess_lang=True),
@@ -23,27 +60,80 @@ def render_markdown(text: str) -> str:
             ],
             output_format="html",
         )
+    return md
+
+
+def prewarm() -> None:
+    """Import the markdown/pygments stack and run one throwaway parse (call off the UI thread)."""
+    render_markdown_uncached("# warm-up\n\n```python\nx = 1\n```\n")
+
+
+def render_markdown_uncached(text: str) -> str:
+    """Convert markdown text to HTML without caching (for one-off streaming tails)."""
+    if not _MD_TRIGGERS.search(text):
+        return _plain_text_html(text)
+    try:
+        md = _markdown_parser()
         html = md.convert(text)
         md.reset()
         return html
     except ImportError:
         log.warning("markdown library not available")
-        import html as html_mod
         return f"<pre>{html_mod.escape(text)}</pre>"
 
 
-def escape_js_string(text: str) -> str:
-    """Escape string for safe JavaScript embedding."""
-    if not isinstance(text, str):
-        text = str(text)
-    # 顺序很重要：先转义反斜杠，再转义其他
-    return (text
-        .replace("\\", "\\\\")  # 必须先转义反斜杠
-        .replace("'", "\\'")     # 单引号
-        .replace('"', '\\"')     # 双引号
-        .replace("\n", "\\n")    # 换行
-        .replace("\r", "")       # 回车删除
-        .replace("</script>", "<\\/script>"))  # 防止闭合script
+def split_blocks(text: str, start: int = 0) -> list[str]:
+    """Split text[start:] into top-level markdown blocks.
+
+    在代码围栏之外的空行之后切分；最后一个元素是仍可能增长的尾部块（可能为空串），
+    各块拼接后等于 text[start:]。start 必须本身是一个块边界。
+    """
+    blocks = []
+    block_start = start
+    in_fence = False
+    pos = start
+    while True:
+        nl = text.find("\n", pos)
+        if nl == -1:  # 最后一行可能还不完整
+            break
+        stripped = text[pos:nl].lstrip()
+        if stripped.startswith("```") or stripped.startswith("~~~"):
+            in_fence = not in_fence
+        elif not stripped and not in_fence and pos > block_start:
+            blocks.append(text[block_start:nl + 1])
+            block_start = nl + 1
+        pos = nl + 1
+    blocks.append(text[block_start:])
+    return blocks
+
+
+class StreamRenderCache:
+    """Segment-level markdown rendering for one streaming response.
+
+    已完成的块只渲染一次（按内容缓存），每次刷新只重新渲染尾部块，
+    单次刷新的开销与尾部长度相关，而不是与全文长度相关。
+    分块拼接的结果只用于流式显示，最终消息应对全文调用 render_markdown。
+    """
+
+    def __init__(self) -> None:
+        self._html: dict[str, str] = {}
+        self._stable_end = 0
+
+    def reset(self) -> None:
+        self._html.clear()
+        self._stable_end = 0
+
+    def update(self, full_text: str) -> tuple[str, str]:
+        """Return (HTML of blocks completed since the last call, HTML of the tail block)."""
+        blocks = split_blocks(full_text, self._stable_end)
+        new_html = []
+        for block in blocks[:-1]:
+            html = self._html.get(block)
+            if html is None:
+                html = self._html[block] = render_markdown_uncached(block)
+            new_html.append(html)
+            self._stable_end += len(block)
+        return "".join(new_html), render_markdown_uncached(blocks[-1])
 
 
 def get_chat_html_template(dark_mode: bool = True) -> str:
@@ -185,16 +275,27 @@ code {
 .message.search-match {
     outline: 3px solid #D97706;
 }
+
+/* 扩展思考内容（折叠显示） */
+.thinking {
+    margin: 10px 0;
+    padding: 8px 12px;
+    border-left: 3px solid %(code_border)s;
+    color: %(meta)s;
+    font-size: 13px;
+}
+.thinking summary {
+    cursor: pointer;
+}
 </style>
 <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
 </head>
 <body>
 <div id="chat"></div>
 <div id="stream" class="message assistant">
-    <span id="stream-text"></span>
+    <div id="stream-text"><div id="stream-prefix"></div><div id="stream-tail"></div></div>
     <span style="opacity:0.5;">&#9646;</span>
 </div>
-
 <script type="text/javascript">
 // Global message storage
 var messageStore = {};
@@ -291,9 +392,8 @@ function showCopiedFeedback(btn) {
     }, 2000);
 }
 
-// Core function: Add a message to chat
-function addMessage(role, htmlContent, metaInfo, uid, rawMarkdown) {
-    var chatContainer = document.getElementById('chat');
+// 构建单条消息的 DOM 节点（不插入文档）
+function buildMessageElement(role, htmlContent, metaInfo, uid, rawMarkdown) {
     var msgDiv = document.createElement('div');
     msgDiv.className = 'message ' + role;
     
@@ -343,8 +443,13 @@ function addMessage(role, htmlContent, metaInfo, uid, rawMarkdown) {
         }
         msgDiv.appendChild(metaDiv);
     }
-    
-    chatContainer.appendChild(msgDiv);
+    return msgDiv;
+}
+
+// Core function: Add a message to chat
+function addMessage(role, htmlContent, metaInfo, uid, rawMarkdown) {
+    var chatContainer = document.getElementById('chat');
+    chatContainer.appendChild(buildMessageElement(role, htmlContent, metaInfo, uid, rawMarkdown));
     
             // 处理代码块（添加复制按钮）
             setTimeout(function() {
@@ -359,17 +464,64 @@ function addMessage(role, htmlContent, metaInfo, uid, rawMarkdown) {
     return true;
 }
 
-// Start streaming mode
-function startStreaming() {
-    var streamDiv = document.getElementById('stream');
-    streamDiv.style.display = 'block';
-    document.getElementById('stream-text').innerHTML = '';
+// 批量添加消息：一次 DocumentFragment 插入，只触发一次重排
+function addMessagesBulk(messages) {
+    var frag = document.createDocumentFragment();
+    for (var i = 0; i < messages.length; i++) {
+        var m = messages[i];
+        frag.appendChild(buildMessageElement(m.role, m.html, m.meta, m.uid, m.raw));
+    }
+    document.getElementById('chat').appendChild(frag);
+    try {
+        processCodeBlocks();
+    } catch (e) {
+        // 静默处理错误，不影响消息显示
+    }
     window.scrollTo(0, document.body.scrollHeight);
+    return true;
+}
+
+// 切换对话（不重新加载页面）：第一批清空旧内容，后续批次依次追加
+function replaceHistoryChunk(messages, isFirst) {
+    if (isFirst) {
+        clearSearch();
+        cancelStreaming();
+        clearChat();
+    }
+    addMessagesBulk(messages);
 }
 
-// Append text during streaming
-function appendStreamText(htmlContent) {
-    document.getElementById('stream-text').innerHTML = htmlContent;
+// 流式更新/结束经 QWebChannel 到达，startStreaming/replaceHistoryChunk 经 runJavaScript 到达，
+// 两条通道之间没有顺序保证；每次流式回复带递增 id，页面据此丢弃过期的更新与结束
+var activeStreamId = 0;  // 当前显示的流 id（0 表示无）
+var closedStreamId = 0;  // 已结束或取消的最大流 id
+
+// 第一个到达的 start/update 打开流式区域；已关闭的流返回 false
+function beginStream(streamId) {
+    if (streamId <= closedStreamId) return false;
+    if (streamId !== activeStreamId) {
+        activeStreamId = streamId;
+        document.getElementById('stream').style.display = 'block';
+        document.getElementById('stream-prefix').innerHTML = '';
+        document.getElementById('stream-tail').innerHTML = '';
+        window.scrollTo(0, document.body.scrollHeight);
+    }
+    return true;
+}
+
+// Start streaming mode
+function startStreaming(streamId) {
+    beginStream(streamId);
+}
+
+// 增量流式更新：segmentHtml 为新稳定的片段（追加到前缀末尾，空串表示无新增），
+// tailHtml 替换尾部节点
+function appendStreamTextIncremental(streamId, segmentHtml, tailHtml) {
+    if (!beginStream(streamId)) return;
+    if (segmentHtml) {
+        document.getElementById('stream-prefix').insertAdjacentHTML('beforeend', segmentHtml);
+    }
+    document.getElementById('stream-tail').innerHTML = tailHtml;
     window.scrollTo(0, document.body.scrollHeight);
 }
 
@@ -379,6 +531,42 @@ function finishStreaming(htmlContent, metaInfo, uid, rawMarkdown) {
     addMessage('assistant', htmlContent, metaInfo, uid, rawMarkdown);
 }
 
+// Add a collapsed extended-thinking block
+function addThinking(thinkingHtml) {
+    var details = document.createElement('details');
+    details.className = 'thinking';
+    var summary = document.createElement('summary');
+    summary.textContent = 'Thinking';
+    details.appendChild(summary);
+    var body = document.createElement('div');
+    body.innerHTML = thinkingHtml;
+    details.appendChild(body);
+    document.getElementById('chat').appendChild(details);
+}
+
+// 收起流式区域并关闭该流（省略 streamId 时关闭当前流），之后到达的同 id 更新被丢弃
+function cancelStreaming(streamId) {
+    if (streamId === undefined) streamId = activeStreamId;
+    closedStreamId = Math.max(closedStreamId, streamId);
+    activeStreamId = 0;
+    document.getElementById('stream').style.display = 'none';
+    document.getElementById('stream-prefix').innerHTML = '';
+    document.getElementById('stream-tail').innerHTML = '';
+}
+
+// 流式结束：思考内容与最终消息一次调用完成（finalHtml 为 null 时只收起流式区域）；
+// 已关闭的流（重复结束、结束前已切换对话）直接忽略
+function finalizeMessage(streamId, thinkingHtml, finalHtml, metaInfo, uid, rawMarkdown) {
+    if (streamId <= closedStreamId) return;
+    cancelStreaming(streamId);
+    if (thinkingHtml) {
+        addThinking(thinkingHtml);
+    }
+    if (finalHtml !== null) {
+        finishStreaming(finalHtml, metaInfo, uid, rawMarkdown);
+    }
+}
+
 // Add error message
 function addError(errorMsg) {
     var chatContainer = document.getElementById('chat');
@@ -419,10 +607,14 @@ function clearChat() {
 
 // Expose to window for safety
 window.addMessage = addMessage;
+window.addMessagesBulk = addMessagesBulk;
 window.copyMessageText = copyMessageText;
 window.startStreaming = startStreaming;
-window.appendStreamText = appendStreamText;
+window.appendStreamTextIncremental = appendStreamTextIncremental;
 window.finishStreaming = finishStreaming;
+window.addThinking = addThinking;
+window.finalizeMessage = finalizeMessage;
+window.cancelStreaming = cancelStreaming;
 window.addError = addError;
 window.clearChat = clearChat;
 
@@ -430,6 +622,7 @@ window.clearChat = clearChat;
 var currentSearchQuery = '';
 var searchMatchUids = [];
 var currentMatchIndex = 0;
+var searchFocused = null;  // 当前带高亮框的消息元素
 
 function highlightSearch(query, uids, matchIndex) {
     currentSearchQuery = query;
@@ -449,20 +642,36 @@ function highlightSearch(query, uids, matchIndex) {
     }
     
     // 高亮当前匹配
-    if (searchMatchUids[currentMatchIndex]) {
-        var currentUid = searchMatchUids[currentMatchIndex];
-        var currentMsg = document.getElementById('msg-' + currentUid);
-        if (currentMsg) {
-            currentMsg.style.outline = '3px solid #D97706';
-            currentMsg.scrollIntoView({behavior: 'smooth', block: 'center'});
-        }
+    searchFocused = null;
+    focusSearchMatch();
+}
+
+function focusSearchMatch() {
+    if (searchFocused) {
+        searchFocused.style.outline = 'none';
+        searchFocused = null;
     }
+    var currentUid = searchMatchUids[currentMatchIndex];
+    var currentMsg = currentUid ? document.getElementById('msg-' + currentUid) : null;
+    if (currentMsg) {
+        currentMsg.style.outline = '3px solid #D97706';
+        currentMsg.scrollIntoView({behavior: 'smooth', block: 'center'});
+        searchFocused = currentMsg;
+    }
+}
+
+// 上一条/下一条：匹配列表已在页面中，只切换当前项
+function setSearchIndex(matchIndex) {
+    if (searchMatchUids.length === 0) return;
+    currentMatchIndex = matchIndex;
+    focusSearchMatch();
 }
 
 function clearSearch() {
     currentSearchQuery = '';
     searchMatchUids = [];
     currentMatchIndex = 0;
+    searchFocused = null;
     
     var chatContainer = document.getElementById('chat');
     var allMessages = chatContainer.querySelectorAll('.message');
@@ -473,6 +682,17 @@ function clearSearch() {
 
 window.highlightSearch = highlightSearch;
 window.clearSearch = clearSearch;
+window.setSearchIndex = setSearchIndex;
+
+// QWebChannel：暴露 chatHost，并订阅流式更新信号（替代逐 delta 的 runJavaScript）
+if (typeof QWebChannel !== 'undefined' && window.qt && qt.webChannelTransport) {
+    new QWebChannel(qt.webChannelTransport, function(channel) {
+        window.chatHost = channel.objects.chatHost;
+        chatHost.streamUpdated.connect(appendStreamTextIncremental);
+        chatHost.streamFinished.connect(finalizeMessage);
+        chatHost.channelReady();
+    });
+}
 </script>
 </body>
 </html>""" % colors
@@ -467,6 +467,11 @@ class ThemeManager:
         log.info(f"Applied {'light' if mode == ThemeMode.LIGHT else 'dark'} theme")
 
 
+def get_theme(mode: str) -> str:
+    """按模式名 ('light' / 'dark') 返回主题样式表，未知模式回退到暗色。"""
+    return LIGHT_THEME if mode == ThemeMode.LIGHT.value else DARK_THEME
+
+
 # 全局主题管理器实例
 theme_manager = ThemeManager()
 